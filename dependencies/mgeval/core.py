@@ -23,6 +23,307 @@ def extract_feature(_file):
     return feature
 
 
+def extract_note_events(feature, track_num=1):
+    """
+    This function returns the columnar note event view of a track in the midi pattern.
+    The view is built once per track and cached in the feature dict under 'note_events'.
+
+    Args:
+    'track_num' : specify the track number in the midi pattern, default is 1 (the second track).
+
+    Returns:
+        note_events object of the requested track
+    """
+    cache = feature.setdefault('note_events', {})
+    if track_num not in cache:
+        cache[track_num] = note_events(feature['midi_pattern'], track_num)
+    return cache[track_num]
+
+
+def extract_note_array(feature):
+    """
+    This function returns the notes of the first instrument in the pretty_midi object as an array,
+    built once and cached in the feature dict under 'note_array'. Drum instruments have no pitched notes.
+
+    Returns:
+    'notes': array with one row [pitch, velocity, start, end] per note (times in seconds), shape [num_notes, 4].
+    """
+    if 'note_array' not in feature:
+        instrument = feature['pretty_midi'].instruments[0]
+        notes = np.zeros((0, 4))
+        if not instrument.is_drum and len(instrument.notes) > 0:
+            notes = np.array([[note.pitch, note.velocity, note.start, note.end] for note in instrument.notes])
+        feature['note_array'] = notes
+    return feature['note_array']
+
+
+def extract_pitch_weights(feature, fs=100):
+    """
+    This function computes the duration weighted pitch distribution of the first instrument in the pretty_midi object,
+    i.e. the row sums of its piano roll (sum of velocity * duration of all notes per midi pitch), without rasterising a piano roll.
+    The result is cached in the feature dict under 'pitch_weights'.
+
+    With fs set, note boundaries are quantized to frames of 1/fs seconds like get_piano_roll(fs), i.e. every note lasts
+    int(end * fs) - int(start * fs) frames, so the weights are exactly the row sums of get_piano_roll(fs) (the default
+    fs=100 is the piano roll resolution of the original mgeval features).
+    get_piano_roll also extends notes while the sustain pedal (CC 64) is down and shifts and interpolates the rows of
+    bent pitches, which does not follow from the note durations alone. For instruments with sustain pedal events or pitch
+    bends of at least 1 the piano roll is therefore rasterised as before.
+    With fs=None the exact note durations (in seconds) are used and sustain pedal and pitch bends are ignored.
+
+    Args:
+    'fs' : sampling frequency of the piano roll, None for exact note durations.
+
+    Returns:
+    'weights': duration weighted pitch distribution, shape 128.
+    """
+    cache = feature.setdefault('pitch_weights', {})
+    if fs not in cache:
+        notes = extract_note_array(feature)
+        instrument = feature['pretty_midi'].instruments[0]
+        weights = np.zeros(128)
+        if len(notes) > 0 and fs is not None and (any(cc.number == 64 for cc in instrument.control_changes) or any(abs(bend.pitch) >= 1 for bend in instrument.pitch_bends)):
+            weights = np.sum(instrument.get_piano_roll(fs=fs), axis=1)
+        elif len(notes) > 0:
+            if fs is None:
+                duration = notes[:, 3] - notes[:, 2]
+            else:
+                duration = np.trunc(notes[:, 3] * fs) - np.trunc(notes[:, 2] * fs)
+            weights = np.bincount(notes[:, 0].astype(int), weights=notes[:, 1] * np.maximum(duration, 0), minlength=128)
+        cache[fs] = weights
+    return cache[fs]
+
+
+def extract_bar_lines(feature, num_bar=None):
+    """
+    This function returns the bar lines of the pretty_midi object in seconds, following all time signature changes
+    (default is 4/4) and tempo changes. The result is cached in the feature dict under 'bar_lines'.
+
+    Args:
+    'num_bar': specify the number of bars, if set as None, use the number of bars up to the end of the last note (at least 1).
+
+    Returns:
+    'bar_lines': start time of every bar and end time of the last bar, shape [num_bar + 1].
+    """
+    cache = feature.setdefault('bar_lines', {})
+    key = num_bar
+    if key not in cache:
+        pm_object = feature['pretty_midi']
+        notes = extract_note_array(feature)
+        end_tick = pm_object.time_to_tick(np.max(notes[:, 3])) if len(notes) > 0 else 0
+
+        time_sigs = [(pm_object.time_to_tick(ts.time), ts.numerator * pm_object.resolution * 4. / ts.denominator)
+                     for ts in pm_object.time_signature_changes]
+        if len(time_sigs) == 0 or time_sigs[0][0] > 0:
+            time_sigs.insert(0, (0, 4. * pm_object.resolution))
+
+        bar_ticks = []
+        for i, (tick, bar_length) in enumerate(time_sigs[:-1]):
+            bar_ticks.extend(np.arange(tick, time_sigs[i + 1][0], bar_length))
+        tick, bar_length = time_sigs[-1]
+        required = 1 if num_bar is None else num_bar - len(bar_ticks)
+        last_bars = max(int(math.ceil((end_tick - tick) / bar_length)), required, 1)
+        bar_ticks.extend(tick + np.arange(last_bars + 1) * bar_length)
+        bar_ticks = np.array(bar_ticks)
+
+        if num_bar is None:
+            num_bar = max(int(np.searchsorted(bar_ticks, end_tick, side='left')), 1)
+        # converting the last tick first extends pretty_midi's tick to time table once, instead of once per bar after the end of the sequence
+        pm_object.tick_to_time(int(round(bar_ticks[num_bar])))
+        cache[key] = np.array([pm_object.tick_to_time(int(round(t))) for t in bar_ticks[:num_bar + 1]])
+    return cache[key]
+
+
+def extract_bar_segments(feature, num_bar=None):
+    """
+    This function splits the notes of the first instrument at the bar lines, so that per bar features can be computed
+    with a single bincount over the segments instead of rasterising and reshaping a piano roll. Notes after the last bar are dropped.
+
+    Args:
+    'num_bar': specify the number of bars, if set as None, use the number of bars up to the end of the last note.
+
+    Returns:
+    'segments': dict with one entry per note segment: 'bar' (bar index), 'pitch', 'velocity', 'duration' (in seconds, within the bar)
+                and 'is_onset' (True for the segment that contains the note on).
+    'num_bar': number of bars.
+    """
+    bar_lines = extract_bar_lines(feature, num_bar)
+    num_bar = len(bar_lines) - 1
+    notes = extract_note_array(feature)
+    start, end = notes[:, 2], notes[:, 3]
+
+    start_bar = np.searchsorted(bar_lines, start, side='right') - 1
+    notes_in_bars = (start_bar >= 0) & (start_bar < num_bar)
+    notes, start, end, start_bar = notes[notes_in_bars], start[notes_in_bars], end[notes_in_bars], start_bar[notes_in_bars]
+    end_bar = np.clip(np.searchsorted(bar_lines, end, side='left') - 1, start_bar, num_bar - 1)
+
+    # one segment per bar a note sounds in
+    count = end_bar - start_bar + 1
+    note_index = np.repeat(np.arange(len(notes)), count)
+    bar_offset = np.arange(len(note_index)) - np.repeat(np.cumsum(count) - count, count)
+    bar = start_bar[note_index] + bar_offset
+    duration = np.minimum(end[note_index], bar_lines[bar + 1]) - np.maximum(start[note_index], bar_lines[bar])
+
+    segments = {
+        'bar': bar,
+        'pitch': notes[note_index, 0].astype(int),
+        'velocity': notes[note_index, 1],
+        'duration': np.maximum(duration, 0),
+        'is_onset': bar_offset == 0,
+    }
+    return segments, num_bar
+
+
+# note length classes in units of bar_length/96:
+# [full, half, quarter, 8th, 16th, dot half, dot quarter, dot 8th, dot 16th, half note triplet, quarter note triplet, 8th note triplet]
+LENGTH_CLASSES = np.array([96, 48, 24, 12, 6, 72, 36, 18, 9, 32, 16, 8])
+
+
+class note_events(object):
+    """
+    Columnar view of the note events of a single track in a midi pattern.
+    The event list is walked once; every per-note quantity the rhythm features need is then stored in NumPy arrays
+    with one entry per note on event (in event order), so the features can be computed without rescanning the events.
+
+    Attributes:
+    'onset' : absolute tick of the note on event.
+    'offset' : absolute tick of the first following note off event with the same pitch, -1 if there is none.
+    'pitch', 'velocity' : data of the note on event.
+    'rest_before' : length in ticks of the rest between the preceding note off and the note on, -1 if the note is not preceded by a rest.
+    'ioi' : ticks until the next note on event (of any velocity), -1 if there is none.
+    'bar_length' : bar length in ticks valid at the note on event.
+    """
+    def __init__(self, pattern, track_num=1):
+        track = pattern[track_num]
+        resolution = pattern.resolution
+        num_events = len(track)
+
+        ticks = np.zeros(num_events, dtype=np.int64)
+        kind = np.zeros(num_events, dtype=np.int8)  # 0: other, 1: note on, 2: note off
+        is_note_on_type = np.zeros(num_events, dtype=bool)
+        pitch = np.zeros(num_events, dtype=np.int64)
+        velocity = np.zeros(num_events, dtype=np.int64)
+        time_sig_bar_length = np.zeros(num_events)
+        is_time_sig = np.zeros(num_events, dtype=bool)
+
+        for i, event in enumerate(track):
+            ticks[i] = event.tick
+            event_type = type(event)
+            if event_type == midi.events.TimeSignatureEvent:
+                is_time_sig[i] = True
+                # same bar length formula as the original event-walking implementation
+                time_sig_bar_length[i] = event.data[track_num] * resolution * 4 / 2**(event.data[1])
+            elif event_type == midi.events.NoteOnEvent:
+                is_note_on_type[i] = True
+                pitch[i] = event.data[0]
+                velocity[i] = event.data[1]
+                kind[i] = 1 if event.data[1] != 0 else 2
+            elif event_type == midi.events.NoteOffEvent:
+                pitch[i] = event.data[0]
+                kind[i] = 2
+
+        if getattr(track, 'tick_relative', True):
+            ticks = np.cumsum(ticks)
+
+        event_index = np.arange(num_events)
+        on_index = np.flatnonzero(kind == 1)
+        off_index = np.flatnonzero(kind == 2)
+
+        # bar length: last time signature event before the note, default is 4 beats
+        last_time_sig = np.maximum.accumulate(np.where(is_time_sig, event_index, -1))
+        last_time_sig = last_time_sig[on_index]
+        bar_length = np.where(last_time_sig >= 0, time_sig_bar_length[np.maximum(last_time_sig, 0)], 4. * resolution)
+
+        # matching note off: first note off after the note on with the same pitch
+        key_base = num_events + 1
+        off_keys = np.sort(pitch[off_index] * key_base + off_index)
+        on_keys = pitch[on_index] * key_base + on_index
+        position = np.searchsorted(off_keys, on_keys, side='right')
+        candidate = off_keys[np.minimum(position, len(off_keys) - 1)] if len(off_keys) > 0 else np.zeros(len(on_index), dtype=np.int64)
+        has_off = (position < len(off_keys)) & (candidate // key_base == pitch[on_index])
+        match_index = np.where(has_off, candidate % key_base, num_events)
+        offset = np.where(has_off, ticks[np.minimum(match_index, num_events - 1)], -1)
+
+        # a note off of another pitch at the onset tick (before the matching note off) means the note does not follow a rest
+        onset = ticks[on_index]
+        cumulative_offs = np.concatenate(([0], np.cumsum(kind == 2)))
+        same_tick_end = np.searchsorted(ticks, onset, side='right')
+        blocked = cumulative_offs[np.minimum(match_index, same_tick_end)] - cumulative_offs[on_index + 1] > 0
+
+        # previous note event (the first event of the track is never considered)
+        is_note_event = (kind != 0) & (event_index >= 1)
+        last_note_event = np.maximum.accumulate(np.where(is_note_event, event_index, -1))
+        previous = np.where(on_index >= 1, last_note_event[np.maximum(on_index - 1, 0)], -1)
+        follows_off = (previous >= 0) & (kind[np.maximum(previous, 0)] == 2) & ~blocked
+        rest_before = np.where(follows_off, onset - ticks[np.maximum(previous, 0)], -1)
+
+        # inter onset interval: next note on event, regardless of its velocity
+        on_type_index = np.flatnonzero(is_note_on_type)
+        position = np.searchsorted(on_type_index, on_index, side='right')
+        has_next = position < len(on_type_index)
+        next_index = on_type_index[np.minimum(position, len(on_type_index) - 1)] if len(on_type_index) > 0 else np.zeros(len(on_index), dtype=np.int64)
+        ioi = np.where(has_next, ticks[next_index] - onset, -1)
+
+        self.resolution = resolution
+        self.onset = onset
+        self.offset = offset
+        self.pitch = pitch[on_index]
+        self.velocity = velocity[on_index]
+        self.rest_before = rest_before
+        self.ioi = ioi
+        self.bar_length = bar_length
+
+    def __len__(self):
+        return len(self.onset)
+
+    def length_class(self, lengths, bar_length=None):
+        """
+        Quantizes lengths in ticks to the closest length class.
+
+        Args:
+        'lengths' : lengths in ticks, one per note.
+        'bar_length' : bar lengths in ticks valid for each length, defaults to the bar length of each note.
+
+        Returns:
+        'idx': index of the closest length class for each length.
+        'distance': distance in ticks to the closest length class.
+        """
+        if bar_length is None:
+            bar_length = self.bar_length
+        unit = bar_length / 96.
+        distance = np.abs(unit.reshape(-1, 1) * LENGTH_CLASSES - np.asarray(lengths).reshape(-1, 1))
+        idx = np.argmin(distance, axis=1) if len(distance) > 0 else np.zeros(0, dtype=np.int64)
+        return idx, distance[np.arange(len(idx)), idx]
+
+    def note_length_classes(self):
+        """
+        Returns:
+        'idx': length class of every note with a matching note off, in note order.
+        """
+        has_off = self.offset >= 0
+        idx, _ = self.length_class((self.offset - self.onset)[has_off], self.bar_length[has_off])
+        return idx
+
+    def rest_length_classes(self):
+        """
+        Returns:
+        'idx': length class of every rest that is closer than 3 units (bar_length/96) to a length class, in note order.
+        """
+        has_rest = self.rest_before >= 0
+        bar_length = self.bar_length[has_rest]
+        idx, distance = self.length_class(self.rest_before[has_rest], bar_length)
+        return idx[distance < 3. * (bar_length / 96.)]
+
+    def ioi_classes(self):
+        """
+        Returns:
+        'idx': length class of the inter onset interval of every note that is followed by another note on event.
+        """
+        has_next = self.ioi >= 0
+        idx, _ = self.length_class(self.ioi[has_next], self.bar_length[has_next])
+        return idx
+
+
 # musically informed objective measures.
 class metrics(object):
     def total_used_pitch(self, feature):
@@ -32,65 +333,24 @@ class metrics(object):
         Returns:
         'used_pitch': pitch count, scalar for each sample.
         """
-        piano_roll = feature['pretty_midi'].instruments[0].get_piano_roll(fs=100)
-        sum_notes = np.sum(piano_roll, axis=1)
+        sum_notes = extract_pitch_weights(feature)
         used_pitch = np.sum(sum_notes > 0)
         return used_pitch
 
-    def bar_used_pitch(self, feature, track_num=1, num_bar=None):
+    def bar_used_pitch(self, feature, num_bar=None):
         """
-        bar_used_pitch (Pitch count per bar)
+        bar_used_pitch (Pitch count per bar): The number of different pitches of the notes starting in each bar.
 
         Args:
-        'track_num' : specify the track number in the midi pattern, default is 1 (the second track).
-        'num_bar': specify the number of bars in the midi pattern, if set as None, round to the number of complete bar.
+        'num_bar': specify the number of bars, if set as None, use the number of bars up to the end of the last note.
 
         Returns:
         'used_pitch': with shape of [num_bar,1]
         """
-        pattern = feature['midi_pattern']
-        pattern.make_ticks_abs()
-        resolution = pattern.resolution
-        for i in range(0, len(pattern[track_num])):
-            if type(pattern[track_num][i]) == midi.events.TimeSignatureEvent:
-                time_sig = pattern[track_num][i].data
-                bar_length = time_sig[0] * resolution * 4 / 2**(time_sig[1])
-                if num_bar is None:
-                    num_bar = int(round(float(pattern[track_num][-1].tick) / bar_length))
-                    used_notes = np.zeros((num_bar, 1))
-                else:
-                    used_notes = np.zeros((num_bar, 1))
-
-            elif type(pattern[track_num][i]) == midi.events.NoteOnEvent and pattern[track_num][i].data[1] != 0:
-                if 'time_sig' not in locals():  # set default bar length as 4 beat
-                    bar_length = 4 * resolution
-                    time_sig = [4, 2, 24, 8]
-
-                    if num_bar is None:
-                        num_bar = int(round(float(pattern[track_num][-1].tick) / bar_length))
-                        used_notes = np.zeros((num_bar, 1))
-                        used_notes[(int) (pattern[track_num][i].tick / bar_length)] += 1
-                    else:
-                        used_notes = np.zeros((num_bar, 1))
-                        used_notes[(int) (pattern[track_num][i].tick / bar_length)] += 1
-                    note_list = []
-                    note_list.append(pattern[track_num][i].data[0])
-
-                else:
-                    for j in range(0, num_bar):
-                        if 'note_list'in locals():
-                            pass
-                        else:
-                            note_list = []
-                    note_list.append(pattern[track_num][i].data[0])
-                    used_notes[(int) (pattern[track_num][i].tick / bar_length)] += 1
-
-        used_pitch = np.zeros((num_bar, 1))
-        current_note = 0
-        for i in range(0, num_bar):
-            used_pitch[i] = len(set(note_list[current_note:current_note + int(used_notes[i][0])]))
-            current_note += int(used_notes[i][0])
-
+        segments, num_bar = extract_bar_segments(feature, num_bar)
+        onset = segments['is_onset']
+        bar_pitch = np.unique(segments['bar'][onset] * 128 + segments['pitch'][onset])
+        used_pitch = np.bincount(bar_pitch // 128, minlength=num_bar).reshape((num_bar, 1))
         return used_pitch
 
     def total_used_note(self, feature, track_num=1):
@@ -104,52 +364,21 @@ class metrics(object):
         Returns:
         'used_notes': a scalar for each sample.
         """
-        pattern = feature['midi_pattern']
-        used_notes = 0
-        for i in range(0, len(pattern[track_num])):
-            if type(pattern[track_num][i]) == midi.events.NoteOnEvent and pattern[track_num][i].data[1] != 0:
-                used_notes += 1
+        used_notes = len(extract_note_events(feature, track_num))
         return used_notes
 
-    def bar_used_note(self, feature, track_num=1, num_bar=None):
+    def bar_used_note(self, feature, num_bar=None):
         """
-        bar_used_note (Note count per bar).
+        bar_used_note (Note count per bar): The number of notes starting in each bar.
 
         Args:
-        'track_num' : specify the track number in the midi pattern, default is 1 (the second track).
-        'num_bar': specify the number of bars in the midi pattern, if set as None, round to the number of complete bar.
+        'num_bar': specify the number of bars, if set as None, use the number of bars up to the end of the last note.
 
         Returns:
         'used_notes': with shape of [num_bar, 1]
         """
-        pattern = feature['midi_pattern']
-        pattern.make_ticks_abs()
-        resolution = pattern.resolution
-        for i in range(0, len(pattern[track_num])):
-            if type(pattern[track_num][i]) == midi.events.TimeSignatureEvent:
-                time_sig = pattern[track_num][i].data
-                bar_length = time_sig[track_num] * resolution * 4 / 2**(time_sig[1])
-                if num_bar is None:
-                    num_bar = int(round(float(pattern[track_num][-1].tick) / bar_length))
-                    used_notes = np.zeros((num_bar, 1))
-                else:
-                    used_notes = np.zeros((num_bar, 1))
-
-            elif type(pattern[track_num][i]) == midi.events.NoteOnEvent and pattern[track_num][i].data[1] != 0:
-                if 'time_sig' not in locals():  # set default bar length as 4 beat
-                    bar_length = 4 * resolution
-                    time_sig = [4, 2, 24, 8]
-
-                    if num_bar is None:
-                        num_bar = int(round(float(pattern[track_num][-1].tick) / bar_length))
-                        used_notes = np.zeros((num_bar, 1))
-                        used_notes[(int)(pattern[track_num][i].tick / bar_length)] += 1
-                    else:
-                        used_notes = np.zeros((num_bar, 1))
-                        used_notes[(int) (pattern[track_num][i].tick / bar_length)] += 1
-
-                else:
-                    used_notes[(int)(pattern[track_num][i].tick / bar_length)] += 1
+        segments, num_bar = extract_bar_segments(feature, num_bar)
+        used_notes = np.bincount(segments['bar'][segments['is_onset']], minlength=num_bar).reshape((num_bar, 1))
         return used_notes
 
     def total_pitch_class_histogram(self, feature):
@@ -161,65 +390,28 @@ class metrics(object):
         Returns:
         'histogram': histrogram of 12 pitch, with weighted duration shape 12
         """
-        piano_roll = feature['pretty_midi'].instruments[0].get_piano_roll(fs=100)
-        histogram = np.zeros(12)
-        for i in range(0, 128):
-            pitch_class = i % 12
-            histogram[pitch_class] += np.sum(piano_roll, axis=1)[i]
+        sum_notes = extract_pitch_weights(feature)
+        histogram = np.bincount(np.arange(128) % 12, weights=sum_notes, minlength=12)
         histogram = histogram / sum(histogram)
         return histogram
 
-    def bar_pitch_class_histogram(self, feature, track_num: int = 0, bpm: int = 120, num_bar=None):
+    def bar_pitch_class_histogram(self, feature, num_bar=None):
         """
         bar_pitch_class_histogram (Pitch class histogram per bar):
+        Pitch class histogram weighted by velocity and the duration each note sounds within the bar.
 
         Args:
-        'bpm' : specify the assigned speed in bpm, default is 120 bpm.
-        'num_bar': specify the number of bars in the midi pattern, if set as None, round to the number of complete bar.
-        'track_num' : specify the track number in the midi pattern, default is 1 (the second track).
+        'num_bar': specify the number of bars, if set as None, use the number of bars up to the end of the last note.
 
         Returns:
-        'histogram': with shape of [num_bar, 12]
+        'histogram': with shape of [num_bar, 12], bars without notes are all zero
         """
-
-        # todo: deal with more than one time signature cases
-        pm_object = feature['pretty_midi']
-        if num_bar is None:
-            numer = pm_object.time_signature_changes[-1].numerator if len(pm_object.time_signature_changes) > 0 else 4
-            deno = pm_object.time_signature_changes[-1].denominator if len(pm_object.time_signature_changes) > 0 else 4
-            bar_length = 60. / bpm * numer * 4 / deno * 100
-            piano_roll = pm_object.instruments[track_num].get_piano_roll(fs=100)
-            piano_roll = np.transpose(piano_roll, (1, 0))
-            actual_bar = len(piano_roll) / bar_length
-            num_bar = int(round(actual_bar))
-            bar_length = int(round(bar_length))
-        else:
-            numer = pm_object.time_signature_changes[-1].numerator if len(pm_object.time_signature_changes) > 0 else 4
-            deno = pm_object.time_signature_changes[-1].denominator if len(pm_object.time_signature_changes) > 0 else 4
-            bar_length = 60. / bpm * numer * 4 / deno * 100
-            piano_roll = pm_object.instruments[track_num].get_piano_roll(fs=100)
-            piano_roll = np.transpose(piano_roll, (1, 0))
-            actual_bar = len(piano_roll) / bar_length
-            bar_length = int(math.ceil(bar_length))
-
-        if actual_bar > num_bar:
-            piano_roll = piano_roll[:-np.mod(len(piano_roll), bar_length)].reshape((num_bar, -1, 128))  # make exact bar
-        elif actual_bar == num_bar:
-            piano_roll = piano_roll.reshape((num_bar, -1, 128))
-        else:
-            piano_roll = np.pad(piano_roll, ((0, int(num_bar * bar_length - len(piano_roll))), (0, 0)), mode='constant', constant_values=0)
-            piano_roll = piano_roll.reshape((num_bar, -1, 128))
-
-        bar_histogram = np.zeros((num_bar, 12))
-        for i in range(0, num_bar):
-            histogram = np.zeros(12)
-            for j in range(0, 128):
-                pitch_class = j % 12
-                histogram[pitch_class] += np.sum(piano_roll[i], axis=0)[j]
-            if sum(histogram) != 0:
-                bar_histogram[i] = histogram / sum(histogram)
-            else:
-                bar_histogram[i] = np.zeros(12)
+        segments, num_bar = extract_bar_segments(feature, num_bar)
+        bar_histogram = np.bincount(segments['bar'] * 12 + segments['pitch'] % 12,
+                                    weights=segments['velocity'] * segments['duration'],
+                                    minlength=num_bar * 12).reshape((num_bar, 12))
+        total = np.sum(bar_histogram, axis=1, keepdims=True)
+        bar_histogram = np.divide(bar_histogram, total, out=np.zeros((num_bar, 12)), where=total != 0)
         return bar_histogram
 
     def pitch_class_transition_matrix(self, feature, normalize=0):
@@ -261,8 +453,7 @@ class metrics(object):
         Returns:
         'p_range': a scalar for each sample.
         """
-        piano_roll = feature['pretty_midi'].instruments[0].get_piano_roll(fs=100)
-        pitch_index = np.where(np.sum(piano_roll, axis=1) > 0)
+        pitch_index = np.where(extract_pitch_weights(feature) > 0)
         p_range = np.max(pitch_index) - np.min(pitch_index)
         return p_range
 
@@ -277,23 +468,9 @@ class metrics(object):
         Returns:
         'pitch_shift': a scalar for each sample.
         """
-        pattern = feature['midi_pattern']
-        pattern.make_ticks_abs()
-        resolution = pattern.resolution
-        total_used_note = self.total_used_note(feature, track_num=track_num)
-        d_note = np.zeros((total_used_note - 1))
-        current_note = 0
-        counter = 0
-        for i in range(0, len(pattern[track_num])):
-            if type(pattern[track_num][i]) == midi.events.NoteOnEvent and pattern[track_num][i].data[1] != 0:
-                if counter != 0:
-                    d_note[counter - 1] = current_note - pattern[track_num][i].data[0]
-                    current_note = pattern[track_num][i].data[0]
-                    counter += 1
-                else:
-                    current_note = pattern[track_num][i].data[0]
-                    counter += 1
-        pitch_shift = np.mean(abs(d_note))
+        pitch = extract_note_events(feature, track_num).pitch
+        d_note = pitch[:-1] - pitch[1:]
+        pitch_shift = np.mean(abs(d_note)) if len(d_note) > 0 else np.nan
         pitch_shift = np.nan_to_num(pitch_shift) #custom
         return pitch_shift
 
@@ -330,82 +507,13 @@ class metrics(object):
         'note_length_hist': The output vector has a length of either 12 (or 24 when pause_event is True).
         """
 
-        pattern = feature['midi_pattern']
+        events = extract_note_events(feature, track_num)
         if pause_event is False:
-            note_length_hist = np.zeros((12))
-            pattern.make_ticks_abs()
-            resolution = pattern.resolution
-            # basic unit: bar_length/96
-            for i in range(0, len(pattern[track_num])):
-                if type(pattern[track_num][i]) == midi.events.TimeSignatureEvent:
-                    time_sig = pattern[track_num][i].data
-                    bar_length = time_sig[track_num] * resolution * 4 / 2**(time_sig[1])
-                elif type(pattern[track_num][i]) == midi.events.NoteOnEvent and pattern[track_num][i].data[1] != 0:
-                    if 'time_sig' not in locals():  # set default bar length as 4 beat
-                        bar_length = 4 * resolution
-                        time_sig = [4, 2, 24, 8]
-                    unit = bar_length / 96.
-                    hist_list = [unit * 96, unit * 48, unit * 24, unit * 12, unit * 6, unit * 72, unit * 36, unit * 18, unit * 9, unit * 32, unit * 16, unit * 8]
-                    current_tick = pattern[track_num][i].tick
-                    current_note = pattern[track_num][i].data[0]
-                    # find next note off
-                    for j in range(i, len(pattern[track_num])):
-                        if type(pattern[track_num][j]) == midi.events.NoteOffEvent or (type(pattern[track_num][j]) == midi.events.NoteOnEvent and pattern[track_num][j].data[1] == 0):
-                            if pattern[track_num][j].data[0] == current_note:
-
-                                note_length = pattern[track_num][j].tick - current_tick
-                                distance = np.abs(np.array(hist_list) - note_length)
-                                idx = distance.argmin()
-                                note_length_hist[idx] += 1
-                                break
+            note_length_hist = np.bincount(events.note_length_classes(), minlength=12).astype(np.float64)
         else:
             note_length_hist = np.zeros((24))
-            pattern.make_ticks_abs()
-            resolution = pattern.resolution
-            # basic unit: bar_length/96
-            for i in range(0, len(pattern[track_num])):
-                if type(pattern[track_num][i]) == midi.events.TimeSignatureEvent:
-                    time_sig = pattern[track_num][i].data
-                    bar_length = time_sig[track_num] * resolution * 4 / 2**(time_sig[1])
-                elif type(pattern[track_num][i]) == midi.events.NoteOnEvent and pattern[track_num][i].data[1] != 0:
-                    check_previous_off = True
-                    if 'time_sig' not in locals():  # set default bar length as 4 beat
-                        bar_length = 4 * resolution
-                        time_sig = [4, 2, 24, 8]
-                    unit = bar_length / 96.
-                    tol = 3. * unit
-                    hist_list = [unit * 96, unit * 48, unit * 24, unit * 12, unit * 6, unit * 72, unit * 36, unit * 18, unit * 9, unit * 32, unit * 16, unit * 8]
-                    current_tick = pattern[track_num][i].tick
-                    current_note = pattern[track_num][i].data[0]
-                    # find next note off
-                    for j in range(i, len(pattern[track_num])):
-                        # find next note off
-                        if type(pattern[track_num][j]) == midi.events.NoteOffEvent or (type(pattern[track_num][j]) == midi.events.NoteOnEvent and pattern[track_num][j].data[1] == 0):
-                            if pattern[track_num][j].data[0] == current_note:
-
-                                note_length = pattern[track_num][j].tick - current_tick
-                                distance = np.abs(np.array(hist_list) - note_length)
-                                idx = distance.argmin()
-                                note_length_hist[idx] += 1
-                                break
-                            else:
-                                if pattern[track_num][j].tick == current_tick:
-                                    check_previous_off = False
-
-                    # find previous note off/on
-                    if check_previous_off is True:
-                        for j in range(i - 1, 0, -1):
-                            if type(pattern[track_num][j]) == midi.events.NoteOnEvent and pattern[track_num][j].data[1] != 0:
-                                break
-
-                            elif type(pattern[track_num][j]) == midi.events.NoteOffEvent or (type(pattern[track_num][j]) == midi.events.NoteOnEvent and pattern[track_num][j].data[1] == 0):
-
-                                note_length = current_tick - pattern[track_num][j].tick
-                                distance = np.abs(np.array(hist_list) - note_length)
-                                idx = distance.argmin()
-                                if distance[idx] < tol:
-                                    note_length_hist[idx + 12] += 1
-                                break
+            note_length_hist[:12] = np.bincount(events.note_length_classes(), minlength=12)
+            note_length_hist[12:] = np.bincount(events.rest_length_classes(), minlength=12)
 
         if normalize is False:
             return note_length_hist
@@ -431,32 +539,7 @@ class metrics(object):
         'ioi_hist': The output vector has a length of either 12.
         """
 
-        pattern = feature['midi_pattern']
-        note_length_hist = np.zeros((12))
-        pattern.make_ticks_abs()
-        resolution = pattern.resolution
-        # basic unit: bar_length/96
-        for i in range(0, len(pattern[track_num])):
-            if type(pattern[track_num][i]) == midi.events.TimeSignatureEvent:
-                time_sig = pattern[track_num][i].data
-                bar_length = time_sig[track_num] * resolution * 4 / 2**(time_sig[1])
-            elif type(pattern[track_num][i]) == midi.events.NoteOnEvent and pattern[track_num][i].data[1] != 0:
-                if 'time_sig' not in locals():  # set default bar length as 4 beat
-                    bar_length = 4 * resolution
-                    time_sig = [4, 2, 24, 8]
-                unit = bar_length / 96.
-                hist_list = [unit * 96, unit * 48, unit * 24, unit * 12, unit * 6, unit * 72, unit * 36, unit * 18, unit * 9, unit * 32, unit * 16, unit * 8]
-                current_tick = pattern[track_num][i].tick
-                # find next note on
-                for j in range(i+1, len(pattern[track_num])):
-                    if type(pattern[track_num][j]) == midi.events.NoteOnEvent:
-                        if pattern[track_num][j].tick >= current_tick:
-
-                            ioi = pattern[track_num][j].tick - current_tick
-                            distance = np.abs(np.array(hist_list) - ioi)
-                            idx = distance.argmin()
-                            note_length_hist[idx] += 1
-                            break
+        note_length_hist = np.bincount(extract_note_events(feature, track_num).ioi_classes(), minlength=12).astype(np.float64)
 
         if normalize is False:
             return note_length_hist
@@ -482,92 +565,40 @@ class metrics(object):
         Returns:
         'transition_matrix': The output feature dimension is 12 × 12 (or 24 x 24 when pause_event is True).
         """
-        pattern = feature['midi_pattern']
+        events = extract_note_events(feature, track_num)
+        has_off = events.offset >= 0
+        note_idx, _ = events.length_class((events.offset - events.onset)[has_off], events.bar_length[has_off])
+
         if pause_event is False:
             transition_matrix = np.zeros((12, 12))
-            pattern.make_ticks_abs()
-            resolution = pattern.resolution
-            idx = None
-            # basic unit: bar_length/96
-            for i in range(0, len(pattern[track_num])):
-                if type(pattern[track_num][i]) == midi.events.TimeSignatureEvent:
-                    time_sig = pattern[track_num][i].data
-                    bar_length = time_sig[track_num] * resolution * 4 / 2**(time_sig[1])
-                elif type(pattern[track_num][i]) == midi.events.NoteOnEvent and pattern[track_num][i].data[1] != 0:
-                    if 'time_sig' not in locals():  # set default bar length as 4 beat
-                        bar_length = 4 * resolution
-                        time_sig = [4, 2, 24, 8]
-                    unit = bar_length / 96.
-                    hist_list = [unit * 96, unit * 48, unit * 24, unit * 12, unit * 6, unit * 72, unit * 36, unit * 18, unit * 9, unit * 32, unit * 16, unit * 8]
-                    current_tick = pattern[track_num][i].tick
-                    current_note = pattern[track_num][i].data[0]
-                    # find note off
-                    for j in range(i, len(pattern[track_num])):
-                        if type(pattern[track_num][j]) == midi.events.NoteOffEvent or (type(pattern[track_num][j]) == midi.events.NoteOnEvent and pattern[track_num][j].data[1] == 0):
-                            if pattern[track_num][j].data[0] == current_note:
-                                note_length = pattern[track_num][j].tick - current_tick
-                                distance = np.abs(np.array(hist_list) - note_length)
-
-                                last_idx = idx
-                                idx = distance.argmin()
-                                if last_idx is not None:
-                                    transition_matrix[last_idx][idx] += 1
-                                break
+            np.add.at(transition_matrix, (note_idx[:-1], note_idx[1:]), 1)
         else:
             transition_matrix = np.zeros((24, 24))
-            pattern.make_ticks_abs()
-            resolution = pattern.resolution
-            idx = None
-            # basic unit: bar_length/96
-            for i in range(0, len(pattern[track_num])):
-                if type(pattern[track_num][i]) == midi.events.TimeSignatureEvent:
-                    time_sig = pattern[track_num][i].data
-                    bar_length = time_sig[track_num] * resolution * 4 / 2**(time_sig[1])
-                elif type(pattern[track_num][i]) == midi.events.NoteOnEvent and pattern[track_num][i].data[1] != 0:
-                    check_previous_off = True
-                    if 'time_sig' not in locals():  # set default bar length as 4 beat
-                        bar_length = 4 * resolution
-                        time_sig = [4, 2, 24, 8]
-                    unit = bar_length / 96.
-                    tol = 3. * unit
-                    hist_list = [unit * 96, unit * 48, unit * 24, unit * 12, unit * 6, unit * 72, unit * 36, unit * 18, unit * 9, unit * 32, unit * 16, unit * 8]
-                    current_tick = pattern[track_num][i].tick
-                    current_note = pattern[track_num][i].data[0]
-                    # find next note off
-                    for j in range(i, len(pattern[track_num])):
-                        # find next note off
-                        if type(pattern[track_num][j]) == midi.events.NoteOffEvent or (type(pattern[track_num][j]) == midi.events.NoteOnEvent and pattern[track_num][j].data[1] == 0):
-                            if pattern[track_num][j].data[0] == current_note:
-
-                                note_length = pattern[track_num][j].tick - current_tick
-                                distance = np.abs(np.array(hist_list) - note_length)
-                                last_idx = idx
-                                idx = distance.argmin()
-                                if last_idx is not None:
-                                    transition_matrix[last_idx][idx] += 1
-                                break
-                            else:
-                                if pattern[track_num][j].tick == current_tick:
-                                    check_previous_off = False
-
-                    # find previous note off/on
-                    if check_previous_off is True:
-                        for j in range(i - 1, 0, -1):
-                            if type(pattern[track_num][j]) == midi.events.NoteOnEvent and pattern[track_num][j].data[1] != 0:
-                                break
-
-                            elif type(pattern[track_num][j]) == midi.events.NoteOffEvent or (type(pattern[track_num][j]) == midi.events.NoteOnEvent and pattern[track_num][j].data[1] == 0):
-
-                                note_length = current_tick - pattern[track_num][j].tick
-                                distance = np.abs(np.array(hist_list) - note_length)
-
-                                last_idx = idx
-                                idx = distance.argmin()
-                                if last_idx is not None:
-                                    if distance[idx] < tol:
-                                        idx = last_idx
-                                        transition_matrix[last_idx][idx + 12] += 1
-                                break
+            has_rest = events.rest_before >= 0
+            rest_idx, rest_distance = events.length_class(events.rest_before[has_rest], events.bar_length[has_rest])
+
+            # steps in playing order: per note first the note itself (if it has a note off), then the rest before it (if any)
+            step_value = np.zeros((len(events), 2), dtype=np.int64)
+            step_value[has_off, 0] = note_idx
+            step_value[has_rest, 1] = rest_idx
+            is_close_rest = np.zeros((len(events), 2), dtype=bool)
+            is_close_rest[has_rest, 1] = rest_distance < 3. * (events.bar_length[has_rest] / 96.)
+            is_note = np.zeros((len(events), 2), dtype=bool)
+            is_note[:, 0] = True
+            steps = np.stack((has_off, has_rest), axis=1)
+            step_value, is_close_rest, is_note = step_value[steps], is_close_rest[steps], is_note[steps]
+
+            # the length class carried from step to step: notes and rests that do not fit a length class replace it,
+            # a rest that fits a length class keeps it and counts as a transition from the carried class to the rest of the same class
+            sets_class = is_note | ~is_close_rest
+            sets_class[:1] = True
+            step_index = np.arange(len(step_value))
+            last_set = np.maximum.accumulate(np.where(sets_class, step_index, -1))
+            previous_class = step_value[last_set[:-1]]
+            note_step = is_note[1:]
+            rest_step = is_close_rest[1:] & ~is_note[1:]
+            np.add.at(transition_matrix, (previous_class[note_step], step_value[1:][note_step]), 1)
+            np.add.at(transition_matrix, (previous_class[rest_step], previous_class[rest_step] + 12), 1)
 
         if normalize == 0:
             return transition_matrix
@@ -602,35 +633,9 @@ class metrics(object):
         Returns:
         'transition_matrix': The output feature dimension is 12 × 12 (or 24 x 24 when pause_event is True).
         """
-        pattern = feature['midi_pattern']
+        ioi_idx = extract_note_events(feature, track_num).ioi_classes()
         transition_matrix = np.zeros((12, 12))
-        pattern.make_ticks_abs()
-        resolution = pattern.resolution
-        idx = None
-        # basic unit: bar_length/96
-        for i in range(0, len(pattern[track_num])):
-            if type(pattern[track_num][i]) == midi.events.TimeSignatureEvent:
-                time_sig = pattern[track_num][i].data
-                bar_length = time_sig[track_num] * resolution * 4 / 2**(time_sig[1])
-            elif type(pattern[track_num][i]) == midi.events.NoteOnEvent and pattern[track_num][i].data[1] != 0:
-                if 'time_sig' not in locals():  # set default bar length as 4 beat
-                    bar_length = 4 * resolution
-                    time_sig = [4, 2, 24, 8]
-                unit = bar_length / 96.
-                hist_list = [unit * 96, unit * 48, unit * 24, unit * 12, unit * 6, unit * 72, unit * 36, unit * 18, unit * 9, unit * 32, unit * 16, unit * 8]
-                current_tick = pattern[track_num][i].tick
-                # find next note on
-                for j in range(i+1, len(pattern[track_num])):
-                    if type(pattern[track_num][j]) == midi.events.NoteOnEvent:
-                        if pattern[track_num][j].tick >= current_tick:
-                            note_length = pattern[track_num][j].tick - current_tick
-                            distance = np.abs(np.array(hist_list) - note_length)
-
-                            last_idx = idx
-                            idx = distance.argmin()
-                            if last_idx is not None:
-                                transition_matrix[last_idx][idx] += 1
-                            break
+        np.add.at(transition_matrix, (ioi_idx[:-1], ioi_idx[1:]), 1)
 
         if normalize == 0:
             return transition_matrix
@@ -6,9 +6,8 @@ import sys
 import os
 import glob
 import math
-import sklearn
 import numpy as np
-from scipy import stats, integrate
+from scipy import stats, integrate, signal, spatial, special
 
 
 # Calculate overlap between the two PDF
@@ -28,28 +27,133 @@ def kl_dist(A, B, num_sample=1000):
 
 
 def c_dist(A, B, mode='None', normalize=0):
-    c_dist = np.zeros(len(B))
-    for i in range(0, len(B)):
-        if mode == 'None':
-            c_dist[i] = np.linalg.norm(A - B[i])
-        elif mode == 'EMD':
-            if normalize == 1:
-                A_ = sklearn.preprocessing.normalize(A.reshape(1, -1), norm='l1')[0]
-                B_ = sklearn.preprocessing.normalize(B[i].reshape(1, -1), norm='l1')[0]
-            else:
-                A_ = A.reshape(1, -1)[0]
-                B_ = B[i].reshape(1, -1)[0]
-
-            c_dist[i] = stats.wasserstein_distance(A_, B_)
-
-        elif mode == 'KL':
-            if normalize == 1:
-                A_ = sklearn.preprocessing.normalize(A.reshape(1, -1), norm='l1')[0]
-                B_ = sklearn.preprocessing.normalize(B[i].reshape(1, -1), norm='l1')[0]
-            else:
-                A_ = A.reshape(1, -1)[0]
-                B_ = B[i].reshape(1, -1)[0]
-
-            B_[B_ == 0] = 0.00000001
-            c_dist[i] = stats.entropy(A_, B_)
-    return c_dist
+    return c_dist_pairwise(np.asarray(A).reshape(1, -1), B, mode, normalize)[0]
+
+
+# Calculate the distances between every row of A and every row of B at once, shape (len(A), len(B)).
+# 'EMD' treats the values of each row as samples (like stats.wasserstein_distance in the original loop),
+# for rows of equal length this is the mean absolute difference of the sorted rows.
+# 'KL' is stats.entropy of the rows, with zeros in B replaced by 1e-8.
+# 'EMD' and 'KL' compare the rows elementwise, which is done in blocks of rows of A and B so that the intermediate
+# (rows of A, rows of B, row length) arrays have at most max_block_size elements.
+def c_dist_pairwise(A, B, mode='None', normalize=0, max_block_size=2 ** 22):
+    A = np.asarray(A, dtype=np.float64).reshape(len(A), -1)
+    B = np.asarray(B, dtype=np.float64).reshape(len(B), -1)
+    if mode == 'None':
+        return spatial.distance.cdist(A, B)
+
+    if normalize == 1:
+        A = _l1_normalize(A)
+        B = _l1_normalize(B)
+
+    if mode == 'EMD':
+        A = np.sort(A, axis=1)
+        B = np.sort(B, axis=1)
+        block_dist = lambda a, b: np.mean(np.abs(a[:, np.newaxis, :] - b[np.newaxis, :, :]), axis=2)
+    elif mode == 'KL':
+        B = np.where(B == 0, 0.00000001, B)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            A = A / np.sum(A, axis=1, keepdims=True)
+            B = B / np.sum(B, axis=1, keepdims=True)
+        block_dist = lambda a, b: np.sum(special.rel_entr(a[:, np.newaxis, :], b[np.newaxis, :, :]), axis=2)
+    else:
+        return np.zeros((len(A), len(B)))
+
+    row_size = max(A.shape[1], 1)
+    rows_A = max(1, min(len(A), max_block_size // row_size))
+    rows_B = max(1, max_block_size // (rows_A * row_size))
+    dist = np.empty((len(A), len(B)))
+    for start_A in range(0, len(A), rows_A):
+        for start_B in range(0, len(B), rows_B):
+            dist[start_A:start_A + rows_A, start_B:start_B + rows_B] = block_dist(A[start_A:start_A + rows_A], B[start_B:start_B + rows_B])
+    return dist
+
+
+# l1 normalization of each row like sklearn.preprocessing.normalize, rows with a norm of 0 are left unchanged
+def _l1_normalize(X):
+    norm = np.sum(np.abs(X), axis=1, keepdims=True)
+    return X / np.where(norm == 0, 1, norm)
+
+
+# Linearly bin the samples of A onto an equally spaced grid, each sample is split between its two neighbouring grid points.
+# The bins of several sets of samples on the same grid can be summed. All samples must lie within the grid.
+def bin_on_grid(A, grid):
+    A = np.asarray(A, dtype=np.float64).reshape(-1)
+    num_grid = len(grid)
+    dx = (grid[-1] - grid[0]) / (num_grid - 1)
+
+    position = np.clip((A - grid[0]) / dx, 0, num_grid - 1)
+    left = np.minimum(np.floor(position).astype(int), num_grid - 2)
+    fraction = position - left
+    return np.bincount(left, weights=1 - fraction, minlength=num_grid) + np.bincount(left + 1, weights=fraction, minlength=num_grid)
+
+
+# Evaluate a gaussian KDE (bandwidth by Scott's rule, like stats.gaussian_kde) on an equally spaced grid from the linear binning
+# of its samples (bin_on_grid()), their number and standard deviation (ddof=1). The bins are convolved with the kernel via FFT,
+# which costs O(len(grid) * log(len(grid))) regardless of the number of samples.
+def kde_from_bins(weights, grid, num_samples, std):
+    num_grid = len(grid)
+    dx = (grid[-1] - grid[0]) / (num_grid - 1)
+    bandwidth = std * num_samples ** (-1. / 5)
+
+    if bandwidth == 0:
+        return weights / (num_samples * dx)
+
+    half_width = min(int(np.ceil(5 * bandwidth / dx)), num_grid - 1)
+    offsets = np.arange(-half_width, half_width + 1) * dx
+    kernel = np.exp(-0.5 * (offsets / bandwidth) ** 2) / (np.sqrt(2 * np.pi) * bandwidth)
+    return np.maximum(signal.fftconvolve(weights, kernel, mode='same'), 0) / num_samples
+
+
+# Evaluate a gaussian KDE (bandwidth by Scott's rule, like stats.gaussian_kde) of A on an equally spaced grid.
+# The samples are linearly binned onto the grid and convolved with the kernel via FFT, which costs
+# O(len(A) + len(grid) * log(len(grid))) instead of O(len(A) * len(grid)). All samples must lie within the grid.
+def kde_on_grid(A, grid):
+    A = np.asarray(A, dtype=np.float64).reshape(-1)
+    return kde_from_bins(bin_on_grid(A, grid), grid, len(A), np.std(A, ddof=1))
+
+
+# Calculate overlap area and KL distance between the two PDF (as overlap_area and kl_dist),
+# with each KDE evaluated only once on a grid spanning both sets
+def overlap_and_kl_dist(A, B, num_grid=4096, num_sample=1000):
+    A = np.asarray(A, dtype=np.float64).reshape(-1)
+    B = np.asarray(B, dtype=np.float64).reshape(-1)
+    if len(A) < 2 or len(B) < 2:
+        return np.nan, np.nan
+    lower = np.min((np.min(A), np.min(B)))
+    upper = np.max((np.max(A), np.max(B)))
+    if upper == lower:
+        return np.nan, np.nan
+
+    grid = np.linspace(lower, upper, num_grid)
+    return _overlap_and_kl_on_grid(grid, kde_on_grid(A, grid), (np.min(A), np.max(A)), kde_on_grid(B, grid), (np.min(B), np.max(B)), num_sample)
+
+
+# Same as overlap_and_kl_dist(), with B only given by its linear binning on the grid (bin_on_grid()), its number of samples,
+# standard deviation (ddof=1), minimum and maximum, so a large B can be reduced chunk by chunk.
+# The grid must be np.linspace(min of A and B, max of A and B, num_grid) to match overlap_and_kl_dist().
+def binned_overlap_and_kl_dist(A, bins_B, grid, num_B, std_B, min_B, max_B, num_sample=1000):
+    A = np.asarray(A, dtype=np.float64).reshape(-1)
+    if len(A) < 2 or num_B < 2 or grid[-1] == grid[0]:
+        return np.nan, np.nan
+
+    pdf_B = kde_from_bins(bins_B, grid, num_B, std_B)
+    return _overlap_and_kl_on_grid(grid, kde_on_grid(A, grid), (np.min(A), np.max(A)), pdf_B, (min_B, max_B), num_sample)
+
+
+def _overlap_and_kl_on_grid(grid, pdf_A, range_A, pdf_B, range_B, num_sample):
+    pdf_min = np.minimum(pdf_A, pdf_B)
+    overlap = np.sum(pdf_min[1:] + pdf_min[:-1]) * (grid[1] - grid[0]) / 2
+
+    sample_A = np.interp(np.linspace(range_A[0], range_A[1], num_sample), grid, pdf_A)
+    sample_B = np.interp(np.linspace(range_B[0], range_B[1], num_sample), grid, pdf_B)
+    kl = stats.entropy(sample_A, sample_B)
+    return overlap, kl
+
+
+def fast_overlap_area(A, B, num_grid=4096):
+    return overlap_and_kl_dist(A, B, num_grid)[0]
+
+
+def fast_kl_dist(A, B, num_grid=4096, num_sample=1000):
+    return overlap_and_kl_dist(A, B, num_grid, num_sample)[1]
@@ -10,8 +10,11 @@ from src.generation import get_available_generators
 from src.generation.generators.musicrnn_generator import MusicRNNGenerator
 from src.generation.generators.musicvae_generator import MusicVAEGenerator
 from src.db import generations as db
-from src.db.reference_sets import fetch_ref_set_by_id, get_normalization_values_of_ref_set
+from src.db.reference_sets import fetch_ref_set_by_id, get_normalization_values_of_ref_set, get_reference_distributions_of_ref_set
 from src.evaluation.evaluation import Evaluation
+from src.evaluation.evaluation_frame import EvaluationFrame
+from src.evaluation.variance_tracker import VarianceTracker
+from src.evaluation.near_duplicates import NearDuplicateIndex
 from src.io.conversion import note_seq_to_pretty_midi
 
 
@@ -25,14 +28,23 @@ class AppBatch:
         ('Queen: Bohemian Rhapsody', str(ROOT_DIR / Path('midi/examples/monophonic/bohemian_mama_4b.mid')) ),
     ]
 
-    def __init__(self, log: Output):
+    near_duplicate_modes = ['keep', 'drop', 'resample']
+
+    def __init__(self, log: Output, use_cache: bool = False):
+        """
+        Args:
+            use_cache (bool): read and write the analyses of the evaluation (including the sequences fed to the variance tracker)
+                              from and to the persistent feature cache (see Evaluation)
+        """
         self.log = log
+        self.use_cache = use_cache
 
         self.adaptation = Adaptation()
         self.generator = None
         self.checkpoint = None
         self.temperature = None
         self.result = None
+        self.variance_tracker = None
 
         db.create_tables()
 
@@ -101,13 +113,28 @@ class AppBatch:
 
     def set_similarity_reference(self, ref_set_id: int):
         normalization_values = get_normalization_values_of_ref_set(ref_set_id)
-        self.evaluation = Evaluation(normalization_values)
+        reference_distributions = get_reference_distributions_of_ref_set(ref_set_id)
+        self.evaluation = Evaluation(normalization_values, reference_distributions, use_cache=self.use_cache)
 
         ref_set = fetch_ref_set_by_id(ref_set_id)
         self.ref_set = ref_set['name'] + ' (' + ref_set['source'] + ')'
 
 
-    def run(self, input_file_path: str, generation_amount: int, store_results: bool = True):
+    def run(self, input_file_path: str, generation_amount: int, store_results: bool = True, near_duplicates: str = None, max_resample_attempts: int = 5):
+        """ 
+        Runs a batch of generations and adaptations for an input melody and evaluates them.
+
+        Args:
+            near_duplicates (str): handling of generations that are near-duplicates of an earlier generation of the batch (see near_duplicate_modes):
+                                   None skips the detection, 'keep' keeps and counts them, 'drop' leaves them out of the batch,
+                                   'resample' generates a new melody (up to max_resample_attempts times)
+
+        Raises:
+            ValueError: if near_duplicates is not None or one of near_duplicate_modes
+        """
+        if near_duplicates is not None and near_duplicates not in self.near_duplicate_modes:
+            raise ValueError('Unknown near-duplicate mode ' + str(near_duplicates) + ', expected None or one of ' + ', '.join(self.near_duplicate_modes))
+
         self.__clear_log() 
 
         # construct melodydata from input
@@ -116,6 +143,9 @@ class AppBatch:
 
         # generations
         generations = []
+        self.variance_tracker = VarianceTracker(initial_capacity=max(2 * generation_amount, 1))
+        duplicate_index = NearDuplicateIndex() if near_duplicates is not None else None
+        near_duplicate_count = 0
 
         for i in range(0, generation_amount):
             # generate
@@ -123,6 +153,22 @@ class AppBatch:
             self.__log("Generating base melody " + str(i+1) + "/" + str(generation_amount) + "...")
             gen_data = self.__run_single_generation(input_data)
 
+            # check for near-duplicates of earlier generations
+            if duplicate_index is not None:
+                duplicate_of = duplicate_index.query(gen_data.sequence)
+                attempts = 0
+                while duplicate_of is not None and near_duplicates == 'resample' and attempts < max_resample_attempts:
+                    self.__log("Melody " + str(i+1) + " is a near-duplicate of melody " + str(duplicate_of+1) + ", generating a new one...")
+                    gen_data = self.__run_single_generation(input_data)
+                    duplicate_of = duplicate_index.query(gen_data.sequence)
+                    attempts += 1
+                if duplicate_of is not None:
+                    near_duplicate_count += 1
+                    if near_duplicates == 'drop':
+                        self.__log("Melody " + str(i+1) + " is a near-duplicate of melody " + str(duplicate_of+1) + " and is dropped.")
+                        continue
+                duplicate_index.add(gen_data.sequence)
+
             # evaluate generation similarity (distance to input)
             generation_similarity = self.evaluation.evaluate_similarity(gen_data.sequence, input_data.sequence)
             gen_data.evaluation = generation_similarity
@@ -132,17 +178,30 @@ class AppBatch:
 
             generations.append(adaptation)
 
+            # track variance while the batch is running
+            # the analyses of the similarity evaluation are reused from the evaluation memo
+            self.variance_tracker.add_analysis(self.evaluation.analyze(adaptation.generated_base_sequence.sequence), 'generation')
+            self.variance_tracker.add_analysis(self.evaluation.analyze(adaptation.output_sequence.sequence), 'adaptation')
+
         # evaluate generation variance (intra set distance)
         generation_variance = None
         adaptation_variance = None
+        generation_inter_set = None
+        adaptation_inter_set = None
         if len(generations) > 1:
-            generation_variance = self.evaluation.evaluate_variance([g.generated_base_sequence.sequence for g in generations])
-            adaptation_variance = self.evaluation.evaluate_variance([g.output_sequence.sequence for g in generations])
+            generation_variance = self.evaluation.evaluate_tracked_variance(self.variance_tracker, tag='generation')
+            adaptation_variance = self.evaluation.evaluate_tracked_variance(self.variance_tracker, tag='adaptation')
+
+            # compare similarity distributions with the reference set (inter set)
+            generation_inter_set = self.evaluation.evaluate_inter_set([g.generation_similarity for g in generations])
+            adaptation_inter_set = self.evaluation.evaluate_inter_set([g.output_similarity for g in generations])
 
 
         # calculate average similarity values for generations set and all adaptation sets
-        generation_avg_similarity = self.evaluation.calc_avg_from_similarity_dicts([g.generation_similarity for g in generations])
-        adaptation_avg_similarity = self.evaluation.calc_avg_from_similarity_dicts([g.output_similarity for g in generations])
+        generation_avg_similarity = EvaluationFrame.from_similarity_dicts([g.generation_similarity for g in generations]).avg()
+        adaptation_avg_similarity = EvaluationFrame.from_similarity_dicts([g.output_similarity for g in generations]).avg()
+        generation_similarity_ci = self.evaluation.calc_bootstrap_confidence_intervals([g.generation_similarity for g in generations])
+        adaptation_similarity_ci = self.evaluation.calc_bootstrap_confidence_intervals([g.output_similarity for g in generations])
         
 
         # store set to database
@@ -159,8 +218,13 @@ class AppBatch:
             'generations': generations,
             'generation_avg_similarity': generation_avg_similarity,
             'adaptation_avg_similarity': adaptation_avg_similarity,
+            'generation_similarity_ci': generation_similarity_ci,
+            'adaptation_similarity_ci': adaptation_similarity_ci,
             'generation_variance': generation_variance,
             'adaptation_variance': adaptation_variance,
+            'generation_inter_set': generation_inter_set,
+            'adaptation_inter_set': adaptation_inter_set,
+            'near_duplicate_count': near_duplicate_count,
             'db_set_id': db_set_id,
             'db_generation_ids': db_generation_ids,
         }
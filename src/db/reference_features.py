@@ -0,0 +1,121 @@
+import os
+import json
+from pathlib import Path
+
+import numpy as np
+
+from definitions import ROOT_DIR
+from src.evaluation.mgeval import analyze_midi_files
+from src.evaluation.feature_vectors import FeatureLayout
+from src.evaluation.reference_index import ReferenceCallIndex
+
+features_dir = ROOT_DIR / Path('data/reference_features')
+
+
+def find_reference_pairs(source_folder: str):
+    """
+    Collects the call-response pairs of a reference data folder (files named NN_call.mid and NN_response.mid in one folder per song).
+
+    Args:
+        source_folder (str): root folder of the reference data set
+
+    Returns:
+        list: tuples in the form of (song_name, pair_number, call_file, response_file), sorted by song name and pair number
+    """
+    pairs = []
+    for root, dirs, files in os.walk(source_folder):
+        for file in files:
+            if "call" in file and "log" not in file:
+                pair_number = file[0:2]
+                response_file = os.path.join(root, pair_number + "_response.mid")
+                song_name = os.path.relpath(root, source_folder)
+                pairs.append((song_name, int(pair_number), os.path.join(root, file), response_file))
+    return sorted(pairs)
+
+
+def store_reference_features(set_id: int, midi_files: list, kind: str = 'response', num_bars: int = 4, workers: int = None):
+    """
+    Analyzes the call or response files of a reference set and stores their packed feature vectors (see evaluation.feature_vectors)
+    as a .npy file, so they can be memory-mapped for the comparison with generated sets.
+
+    Args:
+        set_id (int): id of the reference set
+        midi_files (list): paths of the midi files, in the order of the reference data entries
+        kind (str): 'call' or 'response'
+        num_bars (int): length of the samples in bars
+        workers (int): number of worker processes for the analysis
+
+    Returns:
+        Path: path of the stored feature vectors
+        dict: file path -> error message for every file that could not be analyzed (stored as NaN row)
+    """
+    features, errors = analyze_midi_files(midi_files, num_bars, workers)
+    layout = FeatureLayout(num_bars=num_bars)
+    packed = layout.pack_columns(features) if len(features) > 0 else np.full((len(midi_files), layout.size), np.nan, dtype=np.float32)
+
+    features_dir.mkdir(parents=True, exist_ok=True)
+    path = __features_path(set_id, kind)
+    tmp_path = path.with_suffix('.tmp.npy')
+    np.save(tmp_path, packed)
+    os.replace(tmp_path, path)
+
+    with open(__features_path(set_id, kind).with_suffix('.json'), 'w') as f:
+        json.dump({'num_bars': num_bars, 'features': layout.names, 'files': [str(file) for file in midi_files]}, f)
+
+    return path, errors
+
+
+def load_reference_features(set_id: int, kind: str = 'response', mmap_mode: str = 'r'):
+    """
+    Loads the packed feature vectors of a reference set, memory-mapped by default.
+
+    Returns:
+        np.ndarray: feature vectors of shape (number of samples, layout.size), None if no features are stored for the set
+        FeatureLayout: layout of the vectors
+    """
+    path = __features_path(set_id, kind)
+    if not path.exists():
+        print('[DB] Error: No ' + kind + ' features stored for reference set ' + str(set_id) + '.')
+        return None, None
+
+    with open(path.with_suffix('.json')) as f:
+        meta = json.load(f)
+    return np.load(path, mmap_mode=mmap_mode), FeatureLayout(meta['features'], meta['num_bars'])
+
+
+def load_reference_files(set_id: int, kind: str = 'response'):
+    """
+    Returns:
+        list: paths of the midi files of a reference set in the order of its stored feature vectors, None if no features are stored for the set
+    """
+    path = __features_path(set_id, kind).with_suffix('.json')
+    if not path.exists():
+        return None
+    with open(path) as f:
+        return json.load(f)['files']
+
+
+def load_reference_call_index(set_id: int, weights=None):
+    """
+    Builds a nearest-neighbour index over the stored call features of a reference set (see evaluation.reference_index.ReferenceCallIndex),
+    the response features are memory-mapped and only read for the neighbours of a query.
+
+    Args:
+        set_id (int): id of the reference set
+        weights (dict): optional weight per feature, see ReferenceCallIndex
+
+    Returns:
+        ReferenceCallIndex: index over the calls, None if no call features are stored for the set
+    """
+    calls, layout = load_reference_features(set_id, 'call')
+    if calls is None:
+        return None
+    responses, response_layout = load_reference_features(set_id, 'response')
+    if responses is not None and (response_layout.names != layout.names or response_layout.num_bars != layout.num_bars or len(responses) != len(calls)):
+        print('[DB] Error: Call and response features of reference set ' + str(set_id) + ' do not match.')
+        responses = None
+    return ReferenceCallIndex(layout, calls, responses, weights, load_reference_files(set_id, 'call'), load_reference_files(set_id, 'response'))
+
+
+def __features_path(set_id: int, kind: str):
+    return features_dir / (str(set_id) + '_' + kind + '.npy')
@@ -0,0 +1,131 @@
+import argparse
+import time
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from src.db import reference_sets as db
+from src.db.reference_features import find_reference_pairs
+from src.evaluation.mgeval import analyze_midi_file, calc_distances
+
+
+def build_reference_set(
+        source_folder: str,
+        set_id: int = None,
+        name: str = None,
+        source: str = None,
+        length_in_bars: int = 4,
+        workers: int = None,
+        chunksize: int = 16,
+        batch_size: int = 1000,
+        store_stats: bool = True
+    ):
+    """
+    Analyzes all call-and-response pairs of a reference data folder and stores their similarity distances in the reference_data table.
+    The pairs are analyzed in a process pool and stored in batches of batch_size rows, each batch in a single transaction.
+    Pairs that are already stored for the set are skipped, so an interrupted build continues with the first batch that was not committed.
+
+    Args:
+        source_folder (str): root folder of the reference data set (see reference_features.find_reference_pairs())
+        set_id (int): id of an existing reference set to continue, a new set is created if None
+        name (str): name of the new reference set, defaults to the name of the source folder
+        source (str): source description of the new reference set, defaults to the source folder
+        length_in_bars (int): length of the calls and responses in bars
+        workers (int): number of worker processes, defaults to the number of CPUs. With 1 the pairs are analyzed in the current process.
+        chunksize (int): number of pairs sent to a worker at once
+        batch_size (int): number of rows stored per transaction
+        store_stats (bool): calculate and store the quartiles, minimum and maximum of the distances after the build
+
+    Returns:
+        int: id of the reference set
+        dict: (song_name, pair_number) -> error message for every pair that could not be analyzed (not stored, retried on the next build)
+    """
+    db.create_tables()
+    pairs = find_reference_pairs(source_folder)
+
+    if set_id is None:
+        name = name if name is not None else Path(source_folder).name
+        source = source if source is not None else str(source_folder)
+        set_id = db.store_ref_set(name, len(pairs), length_in_bars, source)
+    else:
+        stored = db.fetch_stored_pairs_of_ref_set(set_id)
+        pairs = [pair for pair in pairs if (pair[0], pair[1]) not in stored]
+        print('[DB] Continuing reference set ' + str(set_id) + ', ' + str(len(stored)) + ' pairs already stored, ' + str(len(pairs)) + ' remaining.')
+
+    tasks = [(song_name, pair_number, call_file, response_file, length_in_bars) for song_name, pair_number, call_file, response_file in pairs]
+    errors = {}
+    num_stored = 0
+    t1 = time.time()
+
+    conn = db.create_connection()
+    # with a single worker the pairs are analyzed in the current process, without the startup and pickling costs of a pool
+    executor = ProcessPoolExecutor(max_workers=workers) if workers != 1 else None
+    try:
+        # the pool only works on one batch at a time, so an interrupted build does not wait for all remaining pairs
+        for start in range(0, len(tasks), batch_size):
+            batch_tasks = tasks[start:start + batch_size]
+            if executor is None:
+                results = map(__analyze_pair_task, batch_tasks)
+            else:
+                results = executor.map(__analyze_pair_task, batch_tasks, chunksize=chunksize)
+
+            batch = []
+            for song_name, pair_number, distances, error in results:
+                if error is not None:
+                    errors[(song_name, pair_number)] = error
+                else:
+                    batch.append((song_name, pair_number, distances))
+            if len(batch) > 0:
+                db.store_ref_data_many(conn, set_id, batch)
+            num_stored += len(batch)
+            print('[DB] Processed ' + str(start + len(batch_tasks)) + '/' + str(len(tasks)) + ' pairs, ' + str(num_stored) + ' stored (' + str(round(time.time() - t1, 1)) + ' sec.)')
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        conn.close()
+
+    print('[DB] Stored ' + str(num_stored) + ' pairs in reference set ' + str(set_id) + ' (' + str(round(time.time() - t1, 1)) + ' sec.), ' + str(len(errors)) + ' failed.')
+
+    if store_stats:
+        db.update_avg_distances_for_set(set_id, db.calc_ref_set_stats(set_id))
+
+    return set_id, errors
+
+
+def __analyze_pair_task(task: tuple):
+    """
+    Worker function of build_reference_set(). Never raises, returns a tuple of (song_name, pair_number, distances, error message).
+    """
+    song_name, pair_number, call_file, response_file, length_in_bars = task
+    try:
+        call_analysis = analyze_midi_file(call_file, length_in_bars)
+        response_analysis = analyze_midi_file(response_file, length_in_bars)
+        if call_analysis is None or response_analysis is None:
+            return song_name, pair_number, None, 'Midi file is empty and can not be analyzed'
+        distances = calc_distances(call_analysis, response_analysis)
+    except Exception as e:
+        return song_name, pair_number, None, type(e).__name__ + ': ' + str(e)
+
+    # reference_data columns are NOT NULL, sqlite stores NaN as NULL
+    invalid = [key for key in db.ref_data_features if not np.isfinite(distances[key])]
+    if len(invalid) > 0:
+        return song_name, pair_number, None, 'Invalid distances for ' + ', '.join(invalid)
+    return song_name, pair_number, distances, None
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Builds a reference set from a folder of call-and-response pairs.')
+    parser.add_argument('source_folder', help='root folder of the reference data set, one sub folder per song with NN_call.mid and NN_response.mid files')
+    parser.add_argument('--set-id', type=int, default=None, help='id of an interrupted reference set to continue')
+    parser.add_argument('--name', default=None, help='name of the new reference set')
+    parser.add_argument('--source', default=None, help='source description of the new reference set')
+    parser.add_argument('--bars', type=int, default=4, help='length of the calls and responses in bars')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--batch-size', type=int, default=1000, help='number of rows stored per transaction')
+    args = parser.parse_args()
+
+    set_id, errors = build_reference_set(args.source_folder, args.set_id, args.name, args.source, args.bars, args.workers, batch_size=args.batch_size)
+    for (song_name, pair_number), error in errors.items():
+        print('[DB] Error: ' + song_name + ' ' + str(pair_number).zfill(2) + ' - ' + error)
@@ -1,4 +1,7 @@
+import os
+import json
 import sqlite3
+import numpy as np
 import pandas as pd
 from sqlite3 import Error
 from pathlib import Path
@@ -9,6 +12,48 @@ from definitions import ROOT_DIR
 
 db_path = ROOT_DIR / Path('data/reference_sets.db')
 
+# columnar copy of the reference_data table, one folder per reference set with one raw float64 file per feature and a meta.json with the number of rows
+columns_dir = ROOT_DIR / Path('data/reference_columns')
+column_dtype = np.dtype('<f8')
+
+# similarity distance columns of the reference_data table
+ref_data_features = [
+    'pitch_count',
+    'pitch_count_per_bar',
+    'pitch_class_histogram',
+    'pitch_class_histogram_per_bar',
+    'pitch_class_transition_matrix',
+    'avg_pitch_interval',
+    'pitch_range',
+    'note_count',
+    'note_count_per_bar',
+    'note_length_histogram',
+    'note_length_transition_matrix',
+    'avg_ioi',
+    'ioi_histogram',
+    'ioi_transition_matrix',
+]
+
+sql_insert_ref_data = """INSERT INTO reference_data(
+                            set_id,
+                            song_name,
+                            pair_number,
+                            pitch_count, 
+                            pitch_count_per_bar, 
+                            pitch_class_histogram, 
+                            pitch_class_histogram_per_bar, 
+                            pitch_class_transition_matrix, 
+                            avg_pitch_interval, 
+                            pitch_range, 
+                            note_count, 
+                            note_count_per_bar, 
+                            note_length_histogram, 
+                            note_length_transition_matrix, 
+                            avg_ioi,
+                            ioi_histogram,
+                            ioi_transition_matrix)
+                            VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+
 
 def create_connection():
     """ 
@@ -127,26 +172,6 @@ def store_ref_data(
     conn = create_connection()
     cursor = conn.cursor()
 
-    sql_insert_ref_data = """INSERT INTO reference_data(
-                                set_id,
-                                song_name,
-                                pair_number,
-                                pitch_count, 
-                                pitch_count_per_bar, 
-                                pitch_class_histogram, 
-                                pitch_class_histogram_per_bar, 
-                                pitch_class_transition_matrix, 
-                                avg_pitch_interval, 
-                                pitch_range, 
-                                note_count, 
-                                note_count_per_bar, 
-                                note_length_histogram, 
-                                note_length_transition_matrix, 
-                                avg_ioi,
-                                ioi_histogram,
-                                ioi_transition_matrix)
-                                VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
-
     cursor.execute(sql_insert_ref_data, (
         set_id,
         song_name,
@@ -168,9 +193,60 @@ def store_ref_data(
     )
 
     conn.commit()
+    __append_ref_data_columns(conn, set_id, [[
+        pitch_count,
+        pitch_count_per_bar,
+        pitch_class_histogram,
+        pitch_class_histogram_per_bar,
+        pitch_class_transition_matrix,
+        avg_pitch_interval,
+        pitch_range,
+        note_count,
+        note_count_per_bar,
+        note_length_histogram,
+        note_length_transition_matrix,
+        avg_ioi,
+        ioi_histogram,
+        ioi_transition_matrix]])
     return cursor.lastrowid
 
 
+def store_ref_data_many(conn: sqlite3.Connection, set_id: int, rows: list):
+    """ 
+    Stores the similarity distances of many call-and-response pairs with a single executemany in one transaction.
+    Either all rows are stored or, if an error occurs, none of them. The rows are appended to the columnar copy of the set afterwards.
+
+    Args:
+        conn (sqlite3.Connection): open database connection, reused for all batches of a build
+        set_id (int): id of the reference set
+        rows (list): tuples in the form of (song_name, pair_number, distances) with distances as dict of feature -> float
+    """
+    params = [(set_id, song_name, pair_number) + tuple(float(distances[key]) for key in ref_data_features) for song_name, pair_number, distances in rows]
+    with conn:
+        conn.executemany(sql_insert_ref_data, params)
+    __append_ref_data_columns(conn, set_id, [row[3:] for row in params])
+
+
+def fetch_stored_pairs_of_ref_set(index: int):
+    """ 
+    Fetches the keys of all call-and-response pairs that are already stored for a reference set.
+
+    Args:
+        index (int): id of the reference set
+
+    Returns:
+        set: tuples in the form of (song_name, pair_number)
+    """
+    sql_fetch_pairs = """SELECT song_name, pair_number FROM reference_data WHERE set_id = ?"""
+
+    conn = create_connection()
+    c = conn.cursor()
+    c.execute(sql_fetch_pairs, (index,))
+    pairs = {(song_name, int(pair_number)) for song_name, pair_number in c.fetchall()}
+    conn.close()
+    return pairs
+
+
 def store_ref_set(
         name: str,
         number_of_samples: int,
@@ -323,5 +399,250 @@ def ref_set_stats_to_dataframe(index: int):
     return pd.read_json(stats[0], orient="index")
 
 def get_normalization_values_of_ref_set(index: int):
-    reference_set = ref_set_stats_to_dataframe(1)
-    return reference_set.loc[['0.5']].to_dict('records')[0]
+    """ 
+    Fetches the median call-response similarity distance of each feature of a reference set, used to normalize similarity distances.
+    The medians are read from the stored stats of the set, or computed from its reference data if the set has no stats.
+
+    Args:
+        index (int): id of the reference set
+
+    Returns:
+        dict: median distance per feature, None if the set has neither stats nor reference data
+    """
+    sql_fetch_stats = """SELECT average_similarity_distances FROM reference_sets WHERE id = ?"""
+
+    conn = create_connection()
+    c = conn.cursor()
+    c.execute(sql_fetch_stats, (index,))
+    stats = c.fetchone()
+    conn.close()
+
+    if stats is not None and stats[0] is not None:
+        return json.loads(stats[0])['0.5']
+
+    distributions = get_reference_distributions_of_ref_set(index)
+    if len(distributions) == 0 or all(len(values) == 0 for values in distributions.values()):
+        print('[DB] Error: Reference set ' + str(index) + ' has no stats and no reference data.')
+        return None
+    return {key: float(np.median(values)) if len(values) > 0 else np.nan for key, values in distributions.items()}
+
+
+def get_reference_distributions_of_ref_set(index: int):
+    """ 
+    Fetches the call-response similarity distances of all pairs of a reference set from its columnar copy.
+
+    Args:
+        index (int): id of the reference set
+
+    Returns:
+        dict: in the form of {feature: np.ndarray of distances}, pairs without a value for a feature are left out
+    """
+    distributions = {}
+    for key in ref_data_features:
+        column = load_ref_data_column(index, key)
+        distributions[key] = np.asarray(column[~np.isnan(column)])
+    return distributions
+
+
+def calc_ref_set_stats(index: int):
+    """ 
+    Calculates the quartiles, minimum and maximum of the call-response similarity distances of a reference set.
+
+    Args:
+        index (int): id of the reference set
+
+    Returns:
+        str: JSON object in the form of {'0.25': {feature: value}, '0.5': ..., '0.75': ..., 'min': ..., 'max': ...}, 
+             as stored by update_avg_distances_for_set()
+    """
+    quartiles = [0.25, 0.5, 0.75]
+    stats = {str(q): {} for q in quartiles}
+    stats['min'] = {}
+    stats['max'] = {}
+    for key in ref_data_features:
+        column = load_ref_data_column(index, key)
+        values = column[~np.isnan(column)]
+        if len(values) == 0:
+            continue
+        for q, value in zip(quartiles, np.quantile(values, quartiles)):
+            stats[str(q)][key] = float(value)
+        stats['min'][key] = float(np.min(values))
+        stats['max'][key] = float(np.max(values))
+    return json.dumps(stats)
+
+
+def store_ref_data_columns(index: int):
+    """ 
+    Writes the columnar copy of a reference set from the reference_data table, replacing an existing one.
+    Only needed for sets whose data was stored before the columnar copy existed, store_ref_data() and store_ref_data_many() keep it up to date.
+
+    Args:
+        index (int): id of the reference set
+
+    Returns:
+        Path: folder of the columnar copy
+    """
+    sql_fetch_columns = "SELECT id, " + ", ".join(ref_data_features) + " FROM reference_data WHERE set_id = ? ORDER BY id"
+
+    conn = create_connection()
+    c = conn.cursor()
+    c.execute(sql_fetch_columns, (index,))
+    rows = np.array(c.fetchall(), dtype=np.float64).reshape(-1, len(ref_data_features) + 1)
+    conn.close()
+
+    last_id = int(rows[-1, 0]) if len(rows) > 0 else 0
+    __write_ref_data_columns(index, rows[:, 1:], last_id)
+    return __columns_path(index)
+
+
+def load_ref_data_column(index: int, feature: str, mmap_mode: str = 'r'):
+    """ 
+    Loads the similarity distances of one feature of all pairs of a reference set from its columnar copy, memory-mapped by default.
+    The copy is created from the reference_data table if it does not exist yet.
+
+    Args:
+        index (int): id of the reference set
+        feature (str): one of ref_data_features
+        mmap_mode (str): passed to np.memmap(), None loads the column into memory
+
+    Returns:
+        np.ndarray: distances in the order of the reference_data entries, NaN for missing values
+    """
+    meta = __load_columns_meta(index)
+    if meta is None:
+        store_ref_data_columns(index)
+        meta = __load_columns_meta(index)
+
+    path = __column_path(index, feature, meta['generation'])
+    if meta['num_rows'] == 0:
+        return np.zeros(0, dtype=np.float64)
+    if mmap_mode is None:
+        return np.fromfile(path, dtype=column_dtype, count=meta['num_rows'])
+    return np.memmap(path, dtype=column_dtype, mode=mmap_mode, shape=(meta['num_rows'],))
+
+
+def get_quantiles_of_ref_set(index: int, q: list, features: list = None):
+    """ 
+    Calculates quantiles of the call-response similarity distances of a reference set, reading only the requested columns.
+
+    Args:
+        index (int): id of the reference set
+        q (list): quantiles between 0 and 1
+        features (list): feature names, defaults to all ref_data_features
+
+    Returns:
+        dict: in the form of {feature: np.ndarray with one value per quantile}, missing values are ignored
+    """
+    features = ref_data_features if features is None else features
+    return {key: np.nanquantile(load_ref_data_column(index, key), q) for key in features}
+
+
+def get_histogram_of_ref_set(index: int, feature: str, bins=10, value_range: tuple = None):
+    """ 
+    Calculates a histogram of the call-response similarity distances of one feature of a reference set (see np.histogram()).
+
+    Returns:
+        np.ndarray: counts per bin
+        np.ndarray: bin edges
+    """
+    column = load_ref_data_column(index, feature)
+    return np.histogram(column[~np.isnan(column)], bins=bins, range=value_range)
+
+
+def get_percentiles_of_ref_set(index: int, feature: str, values):
+    """ 
+    Looks up the percentile ranks of similarity distances within the distribution of one feature of a reference set.
+    Ties count half, like the 'percentile' normalization mode of Evaluation.
+
+    Args:
+        index (int): id of the reference set
+        feature (str): one of ref_data_features
+        values (float or np.ndarray): similarity distances
+
+    Returns:
+        np.ndarray: percentile ranks between 0 and 1, NaN for NaN values
+    """
+    column = load_ref_data_column(index, feature)
+    reference = np.sort(column[~np.isnan(column)])
+    values = np.asarray(values, dtype=np.float64)
+    ranks = (np.searchsorted(reference, values, side='left') + np.searchsorted(reference, values, side='right')) / (2 * len(reference))
+    return np.where(np.isnan(values), np.nan, ranks)
+
+
+def __append_ref_data_columns(conn: sqlite3.Connection, index: int, values: list):
+    """
+    Appends newly stored rows to the end of the column files of a reference set, then updates the number of rows in meta.json.
+    Readers only map the number of rows in meta.json, so they never see a partially appended row.
+    If the copy does not match the table anymore (e.g. rows were stored without this function) or does not exist, it is rewritten from the table instead.
+    """
+    meta = __load_columns_meta(index)
+    if meta is None:
+        store_ref_data_columns(index)
+        return
+
+    # rows are only ever added with increasing ids, so everything stored since the last update has an id above the last known one
+    sql_fetch_new_rows = """SELECT count(*), max(id) FROM reference_data WHERE id > ? AND set_id = ?"""
+    num_new_rows, last_id = conn.execute(sql_fetch_new_rows, (meta['last_id'], index)).fetchone()
+    if num_new_rows != len(values):
+        store_ref_data_columns(index)
+        return
+
+    values = np.array(values, dtype=column_dtype).reshape(-1, len(ref_data_features))
+    for i, key in enumerate(ref_data_features):
+        with open(__column_path(index, key, meta['generation']), 'r+b') as f:
+            # drop bytes of an append that was interrupted before meta.json was updated
+            f.truncate(meta['num_rows'] * values.itemsize)
+            f.seek(0, os.SEEK_END)
+            f.write(np.ascontiguousarray(values[:, i]).tobytes())
+
+    __write_columns_meta(index, {**meta, 'num_rows': meta['num_rows'] + len(values), 'last_id': last_id})
+
+
+def __write_ref_data_columns(index: int, values: np.ndarray, last_id: int):
+    """
+    Writes a new generation of column files and then switches meta.json to it, so readers either map the old or the new columns, never a partial one.
+    The files of the previous generation are removed afterwards (if they are not mapped by a reader, which prevents the removal on Windows).
+    """
+    path = __columns_path(index)
+    path.mkdir(parents=True, exist_ok=True)
+    meta = __load_columns_meta(index)
+    generation = 0 if meta is None else meta['generation'] + 1
+
+    for i, key in enumerate(ref_data_features):
+        np.ascontiguousarray(values[:, i], dtype=column_dtype).tofile(str(__column_path(index, key, generation)))
+    __write_columns_meta(index, {'num_rows': len(values), 'last_id': last_id, 'generation': generation, 'features': ref_data_features})
+
+    for key in ref_data_features:
+        old_paths = [path / (key + '.npy')] if meta is None else [__column_path(index, key, meta['generation'])]
+        for old_path in old_paths:
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+
+
+def __write_columns_meta(index: int, meta: dict):
+    tmp_path = __columns_path(index) / 'meta.tmp.json'
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, __columns_path(index) / 'meta.json')
+
+
+def __load_columns_meta(index: int):
+    meta_path = __columns_path(index) / 'meta.json'
+    if not meta_path.exists():
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    # copies written by an earlier format (one .npy file per column) are rewritten
+    if 'generation' not in meta:
+        return None
+    return meta
+
+
+def __column_path(index: int, feature: str, generation: int):
+    return __columns_path(index) / (feature + '.' + str(generation) + '.f64')
+
+
+def __columns_path(index: int):
+    return columns_dir / str(index)
@@ -1 +1,6 @@
-from .evaluation import Evaluation
\ No newline at end of file
+from .evaluation import Evaluation
+from .evaluation_frame import EvaluationFrame
+from .variance_tracker import VarianceTracker
+from .feature_vectors import FeatureLayout
+from .near_duplicates import NearDuplicateIndex
+from .reference_index import ReferenceCallIndex
@@ -1,6 +1,12 @@
+import hashlib
+from collections import OrderedDict
 from typing import List
+import numpy as np
 from pretty_midi.pretty_midi import PrettyMIDI
-from src.evaluation.mgeval import analyze_pretty_midi, calc_distances, calc_intra_set_distances
+from src.evaluation.mgeval import analyze_pretty_midi, analyze_pretty_midis, analyze_pretty_midi_partial, calc_distances, calc_distances_one_to_many, calc_avg_intra_set_distances, feature_registry
+from src.evaluation.variance_tracker import VarianceTracker
+from src.evaluation.feature_vectors import FeatureLayout, calc_packed_distances, calc_inter_set_distance_stats, bin_inter_set_distances
+from dependencies.mgeval.utils import overlap_and_kl_dist, binned_overlap_and_kl_dist
 
 
 class Evaluation():
@@ -8,28 +14,237 @@ class Evaluation():
     pitch_related_keys = ['pitch_count', 'pitch_class_histogram', 'pitch_class_transition_matrix', 'avg_pitch_interval', 'pitch_range']
     rhythm_related_keys = ['note_count', 'note_length_histogram', 'note_length_transition_matrix', 'avg_ioi', 'ioi_histogram', 'ioi_transition_matrix']
 
-    def __init__(self, normalization_factors: dict = None):
+    normalization_modes = ['median', 'percentile']
+
+    # stages of evaluate_cascade(): the first stages only need the notes of the PrettyMIDI object (cheap scalar features first),
+    # the later ones the midi pattern, which has to be written and parsed (the transition matrices last)
+    cascade_stages = [
+        ['pitch_count', 'pitch_range', 'avg_ioi', 'pitch_class_histogram'],
+        ['pitch_count_per_bar', 'pitch_class_histogram_per_bar', 'note_count_per_bar', 'pitch_class_transition_matrix'],
+        ['note_count', 'avg_pitch_interval', 'note_length_histogram', 'ioi_histogram'],
+        ['note_length_transition_matrix', 'ioi_transition_matrix'],
+    ]
+
+    def __init__(self, normalization_factors: dict = None, reference_distributions: dict = None, memo_size: int = 128, normalization_mode: str = 'median',
+                 use_cache: bool = False):
+        """
+        Args:
+            memo_size (int): number of analysis results kept in memory (least recently used ones are dropped first), 0 disables the memo
+            use_cache (bool): read and write analysis results from and to the persistent feature cache (see mgeval.feature_cache), e.g. to evaluate
+                              stored generation files again in a later session. Off by default, because freshly generated sequences are usually
+                              analyzed only once and would grow the cache by one entry each.
+            normalization_mode (str): 'median' divides each distance by the normalization factor (median of the reference set) of its feature,
+                                      'percentile' returns the percentile rank of each distance in the reference distribution of its feature
+        """
         self.normalization_factors = normalization_factors
+        self.set_reference_distributions(reference_distributions)
+        self.set_normalization_mode(normalization_mode)
+        self.memo_size = memo_size
+        self.use_cache = use_cache
+        self.__memo = OrderedDict()
 
 
-    def evaluate_similarity(self, result: PrettyMIDI, control: PrettyMIDI, features: list = None):
-        result_evaluation = analyze_pretty_midi(result)
-        control_evaluation = analyze_pretty_midi(control)
-        similarity_distances = calc_distances(result_evaluation, control_evaluation)
+    def analyze(self, sequence: PrettyMIDI, features: list = None, length_in_bars: int = None):
+        """ 
+        Analyzes a sequence like mgeval.analyze_pretty_midi(). The results are memoized by the fingerprint of the sequence (see fingerprint()),
+        so a sequence that is evaluated repeatedly (e.g. the input melody of a batch) is only analyzed once.
+        Only features missing in a memoized result are computed, and merged into it. With use_cache, sequences that are not memoized
+        are looked up in the persistent feature cache first.
+
+        Returns:
+            dict: feature name -> value, None if the sequence could not be analyzed
+
+        """
+        if self.memo_size <= 0:
+            return analyze_pretty_midi(sequence, length_in_bars, use_cache=self.use_cache, features=features)
+
+        names = [name for name in feature_registry if features is None or name in features]
+        key = (self.fingerprint(sequence), length_in_bars)
+        memoized = self.__memo.get(key, {})
+        missing = [name for name in names if name not in memoized]
+
+        if len(missing) > 0:
+            analysis = analyze_pretty_midi(sequence, length_in_bars, use_cache=self.use_cache, features=missing)
+            if analysis is None:
+                return None
+            memoized = {**memoized, **analysis}
+
+        self.__memoize([key], [memoized])
+        return {name: memoized[name] for name in names}
+
+
+    def analyze_many(self, sequences: List[PrettyMIDI], features: list = None, length_in_bars: int = None, workers: int = None):
+        """ 
+        Same as analyze() for a list of sequences, the sequences that are not memoized are analyzed in a process pool (see mgeval.analyze_pretty_midis()).
+
+        Returns:
+            list: analysis result per sequence, None for sequences that could not be analyzed
+
+        """
+        if self.memo_size <= 0:
+            return analyze_pretty_midis(sequences, length_in_bars, workers, use_cache=self.use_cache, features=features)
+
+        names = [name for name in feature_registry if features is None or name in features]
+        keys = [(self.fingerprint(sequence), length_in_bars) for sequence in sequences]
+        memoized = [self.__memo.get(key, {}) for key in keys]
+        pending = [i for i, analysis in enumerate(memoized) if any(name not in analysis for name in names)]
+
+        if len(pending) > 0:
+            missing = [name for name in names if any(name not in memoized[i] for i in pending)]
+            analyses = analyze_pretty_midis([sequences[i] for i in pending], length_in_bars, workers, use_cache=self.use_cache, features=missing)
+            for i, analysis in zip(pending, analyses):
+                memoized[i] = None if analysis is None else {**memoized[i], **analysis}
+
+        analyzed = [i for i, analysis in enumerate(memoized) if analysis is not None]
+        self.__memoize([keys[i] for i in analyzed], [memoized[i] for i in analyzed])
+        return [None if analysis is None else {name: analysis[name] for name in names} for analysis in memoized]
+
+
+    def fingerprint(self, sequence: PrettyMIDI):
+        """ 
+        Returns:
+            str: hex digest of everything the analysis depends on: resolution, tempo changes, time signatures and the notes,
+                 control changes and pitch bends of all instruments (sustain pedal and pitch bends change the pitch weights, see core.extract_pitch_weights())
+
+        """
+        h = hashlib.sha1()
+        h.update(str(sequence.resolution).encode())
+        for array in sequence.get_tempo_changes():
+            h.update(np.asarray(array, dtype=np.float64).tobytes())
+        h.update(str([(ts.numerator, ts.denominator, ts.time) for ts in sequence.time_signature_changes]).encode())
+        for instrument in sequence.instruments:
+            h.update(str((instrument.program, instrument.is_drum, len(instrument.notes))).encode())
+            h.update(np.array([[note.pitch, note.velocity, note.start, note.end] for note in instrument.notes], dtype=np.float64).tobytes())
+            h.update(str((len(instrument.control_changes), len(instrument.pitch_bends))).encode())
+            h.update(np.array([[cc.number, cc.value, cc.time] for cc in instrument.control_changes], dtype=np.float64).tobytes())
+            h.update(np.array([[bend.pitch, bend.time] for bend in instrument.pitch_bends], dtype=np.float64).tobytes())
+        return h.hexdigest()
 
-        if features is None:
-            return { 'absolute': similarity_distances, 'normalized': self.__normalize(similarity_distances)}
-        else:
-            selection = {}
-            for key in features:
-                if key in similarity_distances:
-                    selection[key] = similarity_distances[key]
-            return { 'absolute': selection, 'normalized': self.__normalize(selection)}
 
+    def clear_memo(self):
+        self.__memo.clear()
 
-    def evaluate_variance(self, sequences: List[PrettyMIDI]):
+
+    def __memoize(self, keys: list, analyses: list):
+        for key, analysis in zip(keys, analyses):
+            self.__memo[key] = analysis
+            self.__memo.move_to_end(key)
+        while len(self.__memo) > self.memo_size:
+            self.__memo.popitem(last=False)
+
+
+    def evaluate_similarity(self, result: PrettyMIDI, control: PrettyMIDI, features: list = None, metric: str = 'euclidean'):
         """ 
-        Takes a list of dictionaries as returned by evaluate_similarity(), calculates the average distance between the values of each feature based on exhaustive cross validation.
+        Calculates the distance between the feature values of a result and a control sequence.
+        If a list of features is given, only these features (and the intermediate results they depend on) are computed.
+        The metric can be 'euclidean' (default), 'EMD' or 'KL' (see mgeval.distance_metrics). Note that the reference sets store euclidean distances,
+        so the normalized values of other metrics are not on the same scale.
+
+        Returns:
+            dict: in the form of {'absolute': distance per feature, 'normalized': normalized distance per feature}
+
+        """
+        result_evaluation = self.analyze(result, features)
+        control_evaluation = self.analyze(control, features)
+        similarity_distances = calc_distances(control_evaluation, result_evaluation, metric)
+
+        return { 'absolute': similarity_distances, 'normalized': self.__normalize(similarity_distances)}
+
+
+    def evaluate_similarity_many(self, results: List[PrettyMIDI], control: PrettyMIDI, features: list = None, metric: str = 'euclidean', workers: int = None):
+        """ 
+        Same as evaluate_similarity() for many results compared with one control sequence: the control is analyzed once, the results in a process pool
+        (see analyze_many()), and the distances of all results are computed in one vectorized operation per feature (see mgeval.calc_distances_one_to_many()).
+
+        Returns:
+            dict: in the form of {'features': feature names, 'absolute': distances of shape (len(results), number of features),
+                                  'normalized': normalized distances of the same shape}, rows of results that could not be analyzed are NaN
+
+        """
+        control_evaluation = self.analyze(control, features)
+        if control_evaluation is None:
+            print('[EVAL] Error: Control sequence could not be analyzed.')
+            return None
+
+        result_evaluations = self.analyze_many(results, features, workers=workers)
+        names, distances = calc_distances_one_to_many(control_evaluation, result_evaluations, metric)
+
+        normalized = self.normalize_columns(names, distances)
+
+        return {'features': names, 'absolute': distances, 'normalized': normalized}
+
+
+    def evaluate_cascade(self, candidates: List[PrettyMIDI], control: PrettyMIDI, threshold: float, stages: List[list] = None, metric: str = 'euclidean'):
+        """ 
+        Evaluates the similarity of many candidates to one control sequence in stages (see cascade_stages), and stops evaluating a candidate
+        as soon as its partial normalized distance exceeds the threshold, so the features of later stages are never computed for it.
+        The intermediate results of each candidate (e.g. its parsed midi pattern) are kept from stage to stage (see mgeval.analyze_pretty_midi_partial()).
+        The threshold applies to the average normalized distance over the meta score features of all stages (the 'avg' meta score). Normalized distances
+        are not negative, so the sum of the features computed so far divided by the number of these features is a lower bound of the average:
+        a rejected candidate would also have exceeded the threshold with the full evaluation.
+        The analyses of the accepted candidates are memoized (see analyze()).
+
+        Returns:
+            dict: in the form of {'accepted': indices of the candidates within the threshold, 'rejected_at_stage': stage index per candidate (None if accepted),
+                                  'features': feature names, 'absolute': distances of shape (len(candidates), number of features),
+                                  'normalized': normalized distances of the same shape}, features that were not computed are NaN
+
+        """
+        stages = self.cascade_stages if stages is None else stages
+        names = [name for stage in stages for name in stage]
+        control_evaluation = self.analyze(control, names)
+        if control_evaluation is None:
+            print('[EVAL] Error: Control sequence could not be analyzed.')
+            return None
+
+        # only the features of the 'avg' meta score that can be normalized count towards the threshold
+        scored = [name for name, is_normalized in zip(names, self.__normalized_keys(names)) if is_normalized and name in self.pitch_related_keys + self.rhythm_related_keys]
+
+        absolute = np.full((len(candidates), len(names)), np.nan)
+        normalized = np.full((len(candidates), len(names)), np.nan)
+        partial = np.zeros(len(candidates))
+        rejected_at_stage = [None] * len(candidates)
+        active = list(range(len(candidates)))
+        analyses = [{} for _ in candidates]
+        feature_dicts = [None] * len(candidates)
+
+        for s, stage in enumerate(stages):
+            if len(active) == 0:
+                break
+            stage_analyses = []
+            for i in active:
+                analysis, feature_dicts[i] = analyze_pretty_midi_partial(candidates[i], stage, feature=feature_dicts[i])
+                stage_analyses.append(analysis)
+                if analysis is not None:
+                    analyses[i].update(analysis)
+
+            stage_control = {name: value for name, value in control_evaluation.items() if name in stage}
+            stage_names, distances = calc_distances_one_to_many(stage_control, stage_analyses, metric)
+            stage_normalized = self.normalize_columns(stage_names, distances)
+            if stage_normalized is None:
+                return None
+
+            columns = [names.index(name) for name in stage_names]
+            absolute[np.ix_(active, columns)] = distances
+            normalized[np.ix_(active, columns)] = stage_normalized
+            partial[active] += np.nansum(stage_normalized[:, [i for i, name in enumerate(stage_names) if name in scored]], axis=1)
+
+            # candidates that could not be analyzed have NaN distances and are rejected as well
+            rejected = np.all(np.isnan(distances), axis=1) | (partial[active] / max(len(scored), 1) > threshold)
+            for i in np.array(active)[rejected]:
+                rejected_at_stage[i] = s
+            active = [i for i, is_rejected in zip(active, rejected) if not is_rejected]
+
+        if self.memo_size > 0:
+            self.__memoize([(self.fingerprint(candidates[i]), None) for i in active], [analyses[i] for i in active])
+
+        return {'accepted': active, 'rejected_at_stage': rejected_at_stage, 'features': names, 'absolute': absolute, 'normalized': normalized}
+
+
+    def evaluate_variance(self, sequences: List[PrettyMIDI], metric: str = 'euclidean', features: list = None):
+        """ 
+        Takes a list of PrettyMIDI sequences, calculates the average distance between the values of each feature over all pairs of sequences.
+        The metric can be 'euclidean' (default), 'EMD' or 'KL' (see evaluate_similarity()), the features can be restricted to a list of feature names.
         Note: Currently returns the average inter-set distance + the average inter-set distance normalized by the similarity ref set.
         This might be revised in the future to another statistical value.
 
@@ -40,25 +255,96 @@ class Evaluation():
         evals = []
 
         for s in sequences:
-            evals.append(analyze_pretty_midi(s))
+            evals.append(self.analyze(s, features))
+
+        result = calc_avg_intra_set_distances(evals, metric=metric)
+
+        return { 'absolute': result, 'normalized': self.__normalize(result)}
 
-        distances = calc_intra_set_distances(evals)
-        keys = evals[0].keys()
-        result = {}
 
-        for i, key in enumerate(keys):
-            total = 0
-            count = 0
-            for el in distances:
-                for distance in el[i]:
-                    total += distance
-                    count += 1
+    def evaluate_tracked_variance(self, tracker: VarianceTracker, indices: list = None, tag: str = None):
+        """ 
+        Same as evaluate_variance(), but reads the distances of an incrementally built set from a VarianceTracker.
+        The sequences can be restricted to a subset by their indices or tag.
+
+        Returns:
+            dict: in the form of {'absolute': avg. absolute eval values, 'normalized': avg. normalized eval values}
 
-            result[key] = total / float(count)
+        """
+        result = tracker.avg_distances(indices, tag)
 
         return { 'absolute': result, 'normalized': self.__normalize(result)}
 
 
+    def evaluate_inter_set(self, lst: List[dict], features: list = None):
+        """ 
+        Takes a list of dictionaries as returned by evaluate_similarity() and compares the distribution of the absolute similarity distances of each feature
+        with the distribution of call-response distances in the reference set, using the overlap area and KL divergence of their KDEs (as in mgeval).
+        Both KDEs are evaluated once on a shared grid, so the comparison is fast enough to be used interactively.
+
+        Returns:
+            dict: in the form of {'overlap': overlap area per feature, 'kl_divergence': KL divergence per feature}, NaN if a distribution has less than 2 values
+
+        """
+        if self.reference_distributions is None:
+            print('[EVAL] Error: No Reference Distributions set.')
+            return None
+
+        if features is None:
+            features = lst[0]['absolute'].keys()
+
+        result = {'overlap': {}, 'kl_divergence': {}}
+        for key in features:
+            values = np.array([dictionary['absolute'][key] for dictionary in lst], dtype=float)
+            overlap, kl = overlap_and_kl_dist(values, self.reference_distributions[key])
+            result['overlap'][key] = overlap
+            result['kl_divergence'][key] = kl
+
+        return result
+
+
+
+    def evaluate_inter_set_distribution(self, sequences: List[PrettyMIDI], reference_vectors, layout: FeatureLayout, chunk_size: int = 4096, num_grid: int = 4096):
+        """ 
+        Compares a set of sequences with the (call or response) samples of a reference set like mgeval: for each feature, the distribution of the
+        intra set distances of the sequences is compared with the distribution of the inter set distances between the sequences and all reference samples,
+        using the overlap area and KL divergence of their KDEs.
+        The reference vectors (e.g. loaded memory-mapped via db.reference_features.load_reference_features()) are streamed in chunks of chunk_size twice:
+        once for the range and spread of the inter set distances and once to bin them onto the KDE grid, so the inter set distances are never held as a whole
+        and memory stays in O(len(sequences) * chunk_size * number of features).
+
+        Returns:
+            dict: in the form of {'overlap': overlap area per feature, 'kl_divergence': KL divergence per feature}
+
+        """
+        vectors = layout.pack_many([self.analyze(s, layout.names, layout.num_bars) for s in sequences])
+
+        intra_set_distances = calc_packed_distances(layout, vectors, vectors)
+        off_diagonal = ~np.eye(len(vectors), dtype=bool)
+        intra_set_distances = intra_set_distances[off_diagonal]
+        intra = [intra_set_distances[:, i][np.isfinite(intra_set_distances[:, i])] for i in range(len(layout))]
+
+        inter = calc_inter_set_distance_stats(layout, vectors, reference_vectors, chunk_size)
+        grids = []
+        for i in range(len(layout)):
+            if len(intra[i]) < 2 or inter['count'][i] < 2:
+                grids.append(None)
+                continue
+            lower = min(np.min(intra[i]), inter['min'][i])
+            upper = max(np.max(intra[i]), inter['max'][i])
+            grids.append(np.linspace(lower, upper, num_grid) if upper > lower else None)
+        bins = bin_inter_set_distances(layout, vectors, reference_vectors, grids, chunk_size)
+
+        result = {'overlap': {}, 'kl_divergence': {}}
+        for i, key in enumerate(layout.names):
+            if grids[i] is None:
+                overlap, kl = np.nan, np.nan
+            else:
+                overlap, kl = binned_overlap_and_kl_dist(intra[i], bins[i], grids[i], inter['count'][i], inter['std'][i], inter['min'][i], inter['max'][i])
+            result['overlap'][key] = overlap
+            result['kl_divergence'][key] = kl
+
+        return result
 
 
 
@@ -66,6 +352,49 @@ class Evaluation():
         self.normalization_factors = normalization_factors
 
 
+    def set_reference_distributions(self, reference_distributions: dict):
+        self.reference_distributions = reference_distributions
+        # sorted once, so the percentile rank of a distance is a binary search
+        self.__sorted_reference_distributions = None
+        if reference_distributions is not None:
+            self.__sorted_reference_distributions = {key: np.sort(np.asarray(values, dtype=np.float64)) for key, values in reference_distributions.items()}
+
+
+    def set_normalization_mode(self, normalization_mode: str):
+        if normalization_mode not in self.normalization_modes:
+            print('[EVAL] Error: Unknown normalization mode ' + str(normalization_mode) + ', using median normalization.')
+            normalization_mode = 'median'
+        self.normalization_mode = normalization_mode
+
+
+    def normalize_columns(self, names: list, distances: np.ndarray):
+        """
+        Normalizes distances given as an array whose last axis are the features in names, with the current normalization mode
+        (e.g. the columns of an EvaluationFrame).
+        The percentile rank is the fraction of reference distances below the distance, with equal reference distances counting half.
+        Features that can not be normalized (see __normalized_keys()) are NaN.
+        """
+        if self.normalization_mode == 'percentile':
+            if self.__sorted_reference_distributions is None:
+                print('[EVAL] Error: No Reference Distributions set.')
+                return None
+            normalized = np.full(distances.shape, np.nan)
+            for i, (key, is_normalized) in enumerate(zip(names, self.__normalized_keys(names))):
+                if not is_normalized:
+                    continue
+                reference = self.__sorted_reference_distributions[key]
+                values = distances[..., i]
+                rank = (np.searchsorted(reference, values, side='left') + np.searchsorted(reference, values, side='right')) / (2. * len(reference))
+                normalized[..., i] = np.where(np.isnan(values), np.nan, rank)
+            return normalized
+
+        if self.normalization_factors is None:
+            print('[EVAL] Error: No Normalization Factors set.')
+            return None
+        factors = np.array([self.normalization_factors[key] if is_normalized else np.nan for key, is_normalized in zip(names, self.__normalized_keys(names))], dtype=np.float64)
+        return distances / factors
+
+
 
     def calc_avg_from_similarity_dicts(self, lst: List[dict]):
         """ 
@@ -87,37 +416,93 @@ class Evaluation():
         
         return result
 
-    def calc_meta_scores(self, evaluation_dict: dict):
-        total = 0
-        for key, value in evaluation_dict.items():
-            total += float(value)
-        avg = total / float(len(evaluation_dict))
+    def calc_bootstrap_confidence_intervals(self, lst: List[dict], num_resamples: int = 2000, confidence: float = 0.95, seed: int = None):
+        """ 
+        Takes a list of dictionaries as returned by evaluate_similarity() and calculates bootstrap confidence intervals (percentile method)
+        of the average of each feature and of the meta scores of the averages (see calc_meta_scores()).
+        All resamples are drawn at once: the number of times each dictionary is drawn per resample is counted into a (num_resamples, len(lst)) matrix,
+        the averages of all resamples are then a single matrix product with the (len(lst), number of features) matrix of values.
 
-        total = 0
-        for key in self.pitch_related_keys:
-            total += float(evaluation_dict[key])
-        pitch_avg = total / float(len(self.pitch_related_keys))
+        Returns:
+            dict: in the form of {'absolute': {feature: (lower, upper)}, 'normalized': {feature: (lower, upper)},
+                                  'meta': {'absolute': {score: (lower, upper)}, 'normalized': {score: (lower, upper)}}}
 
-        total = 0
-        for key in self.rhythm_related_keys:
-            total += float(evaluation_dict[key])
-        rhythm_avg = total / float(len(self.rhythm_related_keys))
+        """
+        rng = np.random.default_rng(seed)
+        num_samples = len(lst)
+        draws = rng.integers(0, num_samples, size=(num_resamples, num_samples))
+        counts = np.bincount((draws + num_samples * np.arange(num_resamples)[:, np.newaxis]).reshape(-1), minlength=num_resamples * num_samples)
+        counts = counts.reshape(num_resamples, num_samples) / float(num_samples)
+        percentiles = [50 * (1 - confidence), 50 * (1 + confidence)]
+
+        result = {'absolute': {}, 'normalized': {}, 'meta': {}}
+        for result_key in ['absolute', 'normalized']:
+            if lst[0][result_key] is None:
+                result[result_key] = None
+                result['meta'][result_key] = None
+                continue
+            keys = list(lst[0][result_key].keys())
+            values = np.array([[float(dictionary[result_key][key]) for key in keys] for dictionary in lst])
+            averages = counts @ values
+
+            intervals = np.percentile(averages, percentiles, axis=0)
+            result[result_key] = {key: (intervals[0, i], intervals[1, i]) for i, key in enumerate(keys)}
+
+            meta_scores = {
+                'avg': averages[:, [i for i, key in enumerate(keys) if key in self.pitch_related_keys + self.rhythm_related_keys]],
+                'pitch_related_avg': averages[:, [i for i, key in enumerate(keys) if key in self.pitch_related_keys]],
+                'rhythm_related_avg': averages[:, [i for i, key in enumerate(keys) if key in self.rhythm_related_keys]],
+            }
+            result['meta'][result_key] = {}
+            for score, score_averages in meta_scores.items():
+                interval = np.percentile(np.mean(score_averages, axis=1), percentiles) if score_averages.shape[1] > 0 else (np.nan, np.nan)
+                result['meta'][result_key][score] = (interval[0], interval[1])
 
+        return result
+
+    def calc_meta_scores(self, evaluation_dict: dict):
+        """ 
+        Averages the values of an evaluation dict (e.g. the 'normalized' values of evaluate_similarity()) over the pitch related, the rhythm related
+        and both groups of features. Features that are missing in the dict (e.g. not computed or not normalized) are left out of the averages.
+
+        Returns:
+            dict: in the form of {'avg': value, 'pitch_related_avg': value, 'rhythm_related_avg': value}, NaN for groups without any value
+        """
+        pitch_values = [float(evaluation_dict[key]) for key in self.pitch_related_keys if key in evaluation_dict]
+        rhythm_values = [float(evaluation_dict[key]) for key in self.rhythm_related_keys if key in evaluation_dict]
 
         return {
-            'avg': avg,
-            'pitch_related_avg': pitch_avg,
-            'rhythm_related_avg': rhythm_avg
+            'avg': self.__mean(pitch_values + rhythm_values),
+            'pitch_related_avg': self.__mean(pitch_values),
+            'rhythm_related_avg': self.__mean(rhythm_values)
         }
 
 
+    def __mean(self, values: list):
+        return sum(values) / float(len(values)) if len(values) > 0 else np.nan
+
 
     def __normalize(self, evaluation_results: dict):
-        if self.normalization_factors is None:
-            print('[EVAL] Error: No Normalization Factors set.')
-        else:
-            normalized_values = {}
-            for key, value in evaluation_results.items():
-                n = self.normalization_factors[key]
-                normalized_values[key] = value / n
-            return normalized_values
+        """
+        Normalizes a dict of distances, features that can not be normalized (see __normalized_keys()) are left out.
+        """
+        names = list(evaluation_results.keys())
+        normalized = self.normalize_columns(names, np.array([evaluation_results[key] for key in names], dtype=np.float64))
+        if normalized is None:
+            return None
+        return {key: normalized[i] for i, (key, is_normalized) in enumerate(zip(names, self.__normalized_keys(names))) if is_normalized}
+
+
+    def __normalized_keys(self, names: list):
+        """
+        Returns:
+            list: for each feature whether it can be normalized with the current mode: in 'median' mode it needs a finite normalization factor that is not 0
+                  (e.g. the per bar features have a median of 0 in the reference sets stored before they were added, until the sets are rebuilt),
+                  in 'percentile' mode a non-empty reference distribution
+        """
+        if self.normalization_mode == 'percentile':
+            distributions = self.__sorted_reference_distributions or {}
+            return [key in distributions and len(distributions[key]) > 0 for key in names]
+
+        factors = self.normalization_factors or {}
+        return [factors.get(key) is not None and np.isfinite(factors[key]) and factors[key] != 0 for key in names]
@@ -0,0 +1,169 @@
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+from src.evaluation.evaluation import Evaluation
+
+
+class EvaluationFrame():
+    """
+    Columnar container for the similarity evaluations of a set of sequences.
+    The absolute and normalized distances are stored as 2D arrays with one row per evaluation and one named column per feature,
+    so averages, meta scores and normalization are single array operations instead of loops over per-evaluation dicts.
+    """
+
+    def __init__(self, features: List[str], absolute: np.ndarray, normalized: np.ndarray = None):
+        """
+        Args:
+            features (List[str]): feature names, one per column
+            absolute (np.ndarray): absolute distances of shape (number of evaluations, number of features)
+            normalized (np.ndarray): normalized distances of the same shape, None if not available
+        """
+        self.features = list(features)
+        self.absolute = np.asarray(absolute, dtype=np.float64).reshape(-1, len(self.features))
+        self.normalized = None if normalized is None else np.asarray(normalized, dtype=np.float64).reshape(-1, len(self.features))
+        self.pitch_related_columns = [i for i, name in enumerate(self.features) if name in Evaluation.pitch_related_keys]
+        self.rhythm_related_columns = [i for i, name in enumerate(self.features) if name in Evaluation.rhythm_related_keys]
+
+
+    @classmethod
+    def from_similarity_dicts(cls, lst: List[dict]):
+        """
+        Creates a frame from a list of dictionaries as returned by Evaluation.evaluate_similarity(), features that were not normalized are NaN.
+        """
+        features = list(lst[0]['absolute'].keys())
+        absolute = [[dictionary['absolute'][name] for name in features] for dictionary in lst]
+        normalized = None
+        if lst[0]['normalized'] is not None:
+            normalized = [[dictionary['normalized'].get(name, np.nan) for name in features] for dictionary in lst]
+        return cls(features, absolute, normalized)
+
+
+    @classmethod
+    def from_similarity_many(cls, evaluation: dict):
+        """
+        Creates a frame from the result of Evaluation.evaluate_similarity_many() without copying the distances.
+        """
+        return cls(evaluation['features'], evaluation['absolute'], evaluation['normalized'])
+
+
+    def __len__(self):
+        return len(self.absolute)
+
+
+    def column(self, name: str, normalized: bool = False):
+        """
+        Returns:
+            np.ndarray: values of one feature for all evaluations
+        """
+        values = self.normalized if normalized else self.absolute
+        return values[:, self.features.index(name)]
+
+
+    def normalize(self, normalization):
+        """
+        Args:
+            normalization (Evaluation or dict): evaluation whose normalization mode and reference values are used (see Evaluation.normalize_columns()),
+                                                or normalization factors per feature for median normalization
+
+        Returns:
+            EvaluationFrame: new frame with the same absolute distances and the normalized distances, None if the distances can not be normalized
+        """
+        evaluation = normalization if isinstance(normalization, Evaluation) else Evaluation(normalization_factors=normalization, memo_size=0)
+        normalized = evaluation.normalize_columns(self.features, self.absolute)
+        if normalized is None:
+            return None
+        return EvaluationFrame(self.features, self.absolute, normalized)
+
+
+    def avg(self):
+        """
+        Same as Evaluation.calc_avg_from_similarity_dicts().
+
+        Returns:
+            dict: in the form of {'absolute': avg. absolute eval values, 'normalized': avg. normalized eval values}
+        """
+        return {
+            'absolute': self.__to_dict(np.mean(self.absolute, axis=0)),
+            'normalized': None if self.normalized is None else self.__to_dict(np.mean(self.normalized, axis=0), self.__normalized_columns()),
+        }
+
+
+    def meta_scores(self, normalized: bool = True):
+        """
+        Calculates the meta scores (see Evaluation.calc_meta_scores()) of every evaluation, features that were not normalized are left out.
+
+        Returns:
+            dict: in the form of {'avg': array, 'pitch_related_avg': array, 'rhythm_related_avg': array} with one value per evaluation
+        """
+        values = self.normalized if normalized else self.absolute
+        pitch_columns, rhythm_columns = self.__meta_score_columns(normalized)
+        return {
+            'avg': self.__mean(values[:, pitch_columns + rhythm_columns], axis=1),
+            'pitch_related_avg': self.__mean(values[:, pitch_columns], axis=1),
+            'rhythm_related_avg': self.__mean(values[:, rhythm_columns], axis=1),
+        }
+
+
+    def avg_meta_scores(self, normalized: bool = True):
+        """
+        Same as Evaluation.calc_meta_scores() of the average values.
+
+        Returns:
+            dict: in the form of {'avg': value, 'pitch_related_avg': value, 'rhythm_related_avg': value}
+        """
+        values = np.mean(self.normalized if normalized else self.absolute, axis=0)
+        pitch_columns, rhythm_columns = self.__meta_score_columns(normalized)
+        return {
+            'avg': self.__mean(values[pitch_columns + rhythm_columns]),
+            'pitch_related_avg': self.__mean(values[pitch_columns]),
+            'rhythm_related_avg': self.__mean(values[rhythm_columns]),
+        }
+
+
+    def to_similarity_dicts(self):
+        """
+        Converts the frame to the dict form returned by Evaluation.evaluate_similarity(), e.g. for the dashboards.
+
+        Returns:
+            list: one dictionary in the form of {'absolute': distance per feature, 'normalized': normalized distance per feature} per evaluation
+        """
+        return [{
+            'absolute': self.__to_dict(self.absolute[i]),
+            'normalized': None if self.normalized is None else self.__to_dict(self.normalized[i], self.__normalized_columns()),
+        } for i in range(len(self))]
+
+
+    def to_dataframe(self, normalized: bool = False):
+        """
+        Returns:
+            pd.DataFrame: one row per evaluation and one column per feature
+        """
+        return pd.DataFrame(self.normalized if normalized else self.absolute, columns=self.features)
+
+
+    def __to_dict(self, row: np.ndarray, columns: list = None):
+        columns = range(len(self.features)) if columns is None else columns
+        return {self.features[i]: row[i] for i in columns}
+
+
+    def __normalized_columns(self):
+        """
+        Returns:
+            list: columns that were normalized, i.e. not NaN for every evaluation (features without a usable normalization factor or reference distribution are skipped)
+        """
+        return [i for i in range(len(self.features)) if not np.all(np.isnan(self.normalized[:, i]))]
+
+
+    def __meta_score_columns(self, normalized: bool):
+        if not normalized:
+            return self.pitch_related_columns, self.rhythm_related_columns
+        columns = self.__normalized_columns()
+        return [i for i in self.pitch_related_columns if i in columns], [i for i in self.rhythm_related_columns if i in columns]
+
+
+    def __mean(self, values: np.ndarray, axis: int = None):
+        if values.shape[-1] == 0:
+            return np.full(values.shape[:-1], np.nan) if axis is not None else np.nan
+        return np.mean(values, axis=axis)
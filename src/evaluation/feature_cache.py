@@ -0,0 +1,83 @@
+import os
+import shutil
+import hashlib
+from pathlib import Path
+
+import numpy as np
+
+from definitions import ROOT_DIR
+
+default_cache_dir = ROOT_DIR / Path('data/mgeval_cache')
+
+
+class FeatureCache():
+    """
+    Persistent, content-addressed cache for mgeval analysis results.
+    Entries are stored as .npz files named by a hash of the midi file bytes (and the analysis parameters) in a sub folder per feature extractor version,
+    so bumping the version invalidates all previously stored entries.
+    """
+
+    def __init__(self, version: int, cache_dir: Path = default_cache_dir):
+        self.version = version
+        self.cache_dir = Path(cache_dir)
+
+
+    @property
+    def version_dir(self):
+        return self.cache_dir / ('v' + str(self.version))
+
+
+    def key(self, midi_bytes: bytes, length_in_bars: int = None):
+        """
+        Returns the cache key of a midi file.
+
+        Args:
+            midi_bytes (bytes): content of the midi file
+            length_in_bars (int): analysis parameter that is part of the key
+
+        Returns:
+            str: hex digest identifying the analysis result
+        """
+        h = hashlib.sha1(midi_bytes)
+        h.update(str(length_in_bars).encode())
+        return h.hexdigest()
+
+
+    def load(self, key: str):
+        """
+        Loads an analysis result from the cache.
+
+        Returns:
+            dict: analysis result as returned by mgeval.analyze_*(), None if the key is not cached
+        """
+        path = self.version_dir / (key + '.npz')
+        if not path.exists():
+            return None
+        try:
+            with np.load(path) as data:
+                return {name: data[name][()] if data[name].ndim == 0 else data[name] for name in data.files}
+        except (OSError, ValueError):
+            return None
+
+
+    def store(self, key: str, analysis: dict):
+        """
+        Stores an analysis result in the cache. The file is written to a temporary path first, so concurrent processes never read partial entries.
+        """
+        self.version_dir.mkdir(parents=True, exist_ok=True)
+        path = self.version_dir / (key + '.npz')
+        tmp_path = self.version_dir / (key + '.' + str(os.getpid()) + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **analysis)
+        os.replace(tmp_path, path)
+
+
+    def clear(self, all_versions: bool = False):
+        """
+        Removes cached entries of older feature extractor versions, or all cached entries if all_versions is True.
+        """
+        if not self.cache_dir.exists():
+            return
+        for version_dir in self.cache_dir.iterdir():
+            if version_dir.is_dir() and (all_versions or version_dir != self.version_dir):
+                shutil.rmtree(version_dir)
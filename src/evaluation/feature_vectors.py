@@ -0,0 +1,283 @@
+from typing import List
+
+import numpy as np
+
+from src.evaluation.mgeval import feature_registry
+from dependencies.mgeval.utils import bin_on_grid
+
+
+# shapes of the mgeval features as returned by mgeval.analyze_*(), 'bars' stands for the number of bars of the layout
+feature_shapes = {
+    'pitch_count': (),
+    'pitch_count_per_bar': ('bars', 1),
+    'pitch_class_histogram': (12,),
+    'pitch_class_histogram_per_bar': ('bars', 12),
+    'pitch_class_transition_matrix': (12, 12),
+    'avg_pitch_interval': (),
+    'pitch_range': (),
+
+    'note_count': (),
+    'note_count_per_bar': ('bars', 1),
+    'note_length_histogram': (24,),
+    'note_length_transition_matrix': (24, 24),
+    'avg_ioi': (),
+    'ioi_histogram': (12,),
+    'ioi_transition_matrix': (12, 12),
+}
+
+
+class FeatureLayout():
+    """
+    Fixed-offset layout of the mgeval features in a packed float32 vector.
+    Every feature is stored flattened in its own segment, the segment table (names, offsets, sizes, shapes) maps the segments back to the features.
+    Per bar features are stored for a fixed number of bars: longer sequences are cut, shorter ones are padded with empty bars.
+    """
+
+    def __init__(self, features: list = None, num_bars: int = 4):
+        self.num_bars = num_bars
+        self.names = [name for name in feature_registry if features is None or name in features]
+        self.shapes = [tuple(num_bars if size == 'bars' else size for size in feature_shapes[name]) for name in self.names]
+        self.sizes = np.array([int(np.prod(shape)) for shape in self.shapes], dtype=np.int64)
+        self.offsets = np.concatenate(([0], np.cumsum(self.sizes)[:-1])).astype(np.int64)
+        self.size = int(np.sum(self.sizes))
+
+
+    def __len__(self):
+        return len(self.names)
+
+
+    def segment(self, name: str):
+        """
+        Returns:
+            slice: position of a feature in the packed vector
+        """
+        i = self.names.index(name)
+        return slice(int(self.offsets[i]), int(self.offsets[i] + self.sizes[i]))
+
+
+    def pack(self, analysis: dict):
+        """
+        Packs an analysis result as returned by mgeval.analyze_*() into a vector, features missing in the analysis are NaN.
+
+        Returns:
+            np.ndarray: float32 vector of length self.size, all NaN if the analysis is None
+        """
+        vector = np.full(self.size, np.nan, dtype=np.float32)
+        if analysis is None:
+            return vector
+
+        for name, shape, offset, size in zip(self.names, self.shapes, self.offsets, self.sizes):
+            if name not in analysis:
+                continue
+            value = np.asarray(analysis[name], dtype=np.float32)
+            if len(shape) > 0 and value.shape != shape:
+                fitted = np.zeros(shape, dtype=np.float32)
+                num_bars = min(value.shape[0], shape[0])
+                fitted[:num_bars] = value[:num_bars]
+                value = fitted
+            vector[offset:offset + size] = value.reshape(-1)
+        return vector
+
+
+    def pack_many(self, analyses: List[dict]):
+        """
+        Returns:
+            np.ndarray: float32 array of shape (len(analyses), self.size) with one packed vector per analysis
+        """
+        packed = np.empty((len(analyses), self.size), dtype=np.float32)
+        for i, analysis in enumerate(analyses):
+            packed[i] = self.pack(analysis)
+        return packed
+
+
+    def pack_columns(self, features: dict):
+        """
+        Packs stacked analysis results as returned by mgeval.analyze_midi_files() (feature name -> array with one row per file).
+
+        Returns:
+            np.ndarray: float32 array of shape (number of files, self.size)
+        """
+        num_rows = len(next(iter(features.values()))) if len(features) > 0 else 0
+        packed = np.full((num_rows, self.size), np.nan, dtype=np.float32)
+        for name, shape, offset, size in zip(self.names, self.shapes, self.offsets, self.sizes):
+            if name not in features:
+                continue
+            column = np.asarray(features[name], dtype=np.float32)
+            if len(shape) > 0 and column.shape[1:] != shape:
+                fitted = np.zeros((num_rows,) + shape, dtype=np.float32)
+                num_bars = min(column.shape[1], shape[0])
+                fitted[:, :num_bars] = column[:, :num_bars]
+                fitted[np.isnan(column).all(axis=tuple(range(1, column.ndim)))] = np.nan
+                column = fitted
+            packed[:, offset:offset + size] = column.reshape(num_rows, -1)
+        return packed
+
+
+    def unpack(self, vector: np.ndarray):
+        """
+        Returns:
+            dict: feature name -> value in the shape returned by mgeval.analyze_*() (with the number of bars of the layout)
+        """
+        return {name: vector[offset:offset + size].reshape(shape) if len(shape) > 0 else vector[offset]
+                for name, shape, offset, size in zip(self.names, self.shapes, self.offsets, self.sizes)}
+
+
+    def weight_vector(self, weights: dict):
+        """
+        Returns:
+            np.ndarray: weight of every feature in the order of the layout, features missing in weights get 0
+        """
+        return np.array([weights.get(name, 0.) for name in self.names], dtype=np.float64)
+
+
+def calc_packed_distances(layout: FeatureLayout, A: np.ndarray, B: np.ndarray, weights=None, chunk_size: int = 64):
+    """
+    Calculates the euclidean distance of every feature between packed feature vectors in one vectorized operation (like mgeval.calc_distances()).
+    A single vector A is compared to all rows of B (one-vs-many), a 2D array A is compared to all rows of B pairwise (many-vs-many).
+    The rows of A are processed in blocks of chunk_size, so memory stays in O(chunk_size * len(B) * layout.size).
+
+    Args:
+        layout (FeatureLayout): layout of the vectors
+        A (np.ndarray): packed vector of shape (layout.size,) or packed vectors of shape (m, layout.size)
+        B (np.ndarray): packed vectors of shape (n, layout.size)
+        weights (dict or np.ndarray): optional weight per feature (by name or in the order of the layout), e.g. 1 / (normalization factor * number of features)
+                                      for the average normalized distance
+
+    Returns:
+        np.ndarray: distances of shape (n, num_features) for one-vs-many or (m, n, num_features) for many-vs-many
+        np.ndarray: weighted sum of the feature distances of shape (n,) or (m, n), only returned if weights are given
+    """
+    A = np.asarray(A, dtype=np.float32)
+    B = np.asarray(B, dtype=np.float32).reshape(-1, layout.size)
+    one_vs_many = A.ndim == 1
+    A = A.reshape(-1, layout.size)
+
+    distances = np.empty((len(A), len(B), len(layout)), dtype=np.float64)
+    for start in range(0, len(A), chunk_size):
+        diff = A[start:start + chunk_size, np.newaxis, :] - B[np.newaxis, :, :]
+        distances[start:start + chunk_size] = np.add.reduceat(np.square(diff), layout.offsets, axis=2, dtype=np.float64)
+    distances = np.sqrt(distances)
+
+    if one_vs_many:
+        distances = distances[0]
+    if weights is None:
+        return distances
+
+    if isinstance(weights, dict):
+        weights = layout.weight_vector(weights)
+    return distances, distances @ np.asarray(weights, dtype=np.float64)
+
+
+def iter_inter_set_distances(layout: FeatureLayout, A: np.ndarray, reference: np.ndarray, chunk_size: int = 4096):
+    """
+    Calculates the euclidean distance of every feature between each vector of A and each vector of a (large) reference set, one chunk of the reference at a time.
+    The reference vectors are read in chunks of chunk_size rows, so a memory-mapped reference array is never loaded as a whole,
+    and the distances of each feature are computed via ||a||^2 + ||b||^2 - 2ab with one matrix product per feature and chunk.
+    Memory stays in O(len(A) * chunk_size * num_features), independent of the size of the reference set.
+
+    Args:
+        layout (FeatureLayout): layout of the vectors
+        A (np.ndarray): packed vectors of shape (m, layout.size)
+        reference (np.ndarray): packed vectors of shape (n, layout.size), e.g. as returned by db.reference_features.load_reference_features()
+        chunk_size (int): number of reference vectors per chunk
+
+    Yields:
+        int: index of the first reference vector of the chunk
+        np.ndarray: float32 distances of shape (m, chunk length, num_features), NaN for reference vectors that could not be analyzed
+    """
+    A = np.asarray(A, dtype=np.float64).reshape(-1, layout.size)
+    squared_A = np.add.reduceat(np.square(A), layout.offsets, axis=1)
+
+    for start in range(0, len(reference), chunk_size):
+        B = np.asarray(reference[start:start + chunk_size], dtype=np.float64)
+        squared_B = np.add.reduceat(np.square(B), layout.offsets, axis=1)
+        distances = np.empty((len(A), len(B), len(layout)), dtype=np.float32)
+        for i, (offset, size) in enumerate(zip(layout.offsets, layout.sizes)):
+            cross = A[:, offset:offset + size] @ B[:, offset:offset + size].T
+            squared = squared_A[:, i, np.newaxis] + squared_B[np.newaxis, :, i] - 2 * cross
+            distances[:, :, i] = np.sqrt(np.maximum(squared, 0))
+        yield start, distances
+
+
+def calc_inter_set_distances(layout: FeatureLayout, A: np.ndarray, reference: np.ndarray, chunk_size: int = 4096):
+    """
+    Same as iter_inter_set_distances(), but collects all distances in one array of shape (m, n, num_features).
+    The output grows with the size of the reference set, use iter_inter_set_distances() or
+    calc_inter_set_distance_stats() / bin_inter_set_distances() to reduce the distances chunk by chunk instead.
+
+    Returns:
+        np.ndarray: float32 distances of shape (m, n, num_features), NaN for reference vectors that could not be analyzed
+    """
+    A = np.asarray(A, dtype=np.float32).reshape(-1, layout.size)
+    distances = np.empty((len(A), len(reference), len(layout)), dtype=np.float32)
+    for start, chunk in iter_inter_set_distances(layout, A, reference, chunk_size):
+        distances[:, start:start + chunk.shape[1]] = chunk
+    return distances
+
+
+def calc_inter_set_distance_stats(layout: FeatureLayout, A: np.ndarray, reference: np.ndarray, chunk_size: int = 4096):
+    """
+    Reduces the inter set distances (see iter_inter_set_distances()) of every feature to their count, mean, variance, minimum and maximum
+    without holding more than one chunk. Distances to reference vectors that could not be analyzed are left out.
+    The mean and variance of the chunks are merged pairwise (Chan et al.), so constant distances have a variance of exactly 0.
+
+    Returns:
+        dict: in the form of {'count': ..., 'mean': ..., 'std': standard deviation (ddof=1), 'min': ..., 'max': ...},
+              each an np.ndarray with one entry per feature, NaN for features with too few distances
+    """
+    count = np.zeros(len(layout), dtype=np.int64)
+    mean = np.zeros(len(layout), dtype=np.float64)
+    squared_deviations = np.zeros(len(layout), dtype=np.float64)
+    minimum = np.full(len(layout), np.inf)
+    maximum = np.full(len(layout), -np.inf)
+
+    for _, distances in iter_inter_set_distances(layout, A, reference, chunk_size):
+        for i in range(len(layout)):
+            values = distances[:, :, i].reshape(-1).astype(np.float64)
+            values = values[np.isfinite(values)]
+            if len(values) == 0:
+                continue
+            chunk_mean = np.mean(values)
+            chunk_squared_deviations = np.sum(np.square(values - chunk_mean))
+            total = count[i] + len(values)
+            delta = chunk_mean - mean[i]
+            mean[i] += delta * len(values) / total
+            squared_deviations[i] += chunk_squared_deviations + delta ** 2 * count[i] * len(values) / total
+            count[i] = total
+            minimum[i] = min(minimum[i], np.min(values))
+            maximum[i] = max(maximum[i], np.max(values))
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        std = np.where(count > 1, np.sqrt(squared_deviations / np.maximum(count - 1, 1)), np.nan)
+    return {
+        'count': count,
+        'mean': np.where(count > 0, mean, np.nan),
+        'std': std,
+        'min': np.where(count > 0, minimum, np.nan),
+        'max': np.where(count > 0, maximum, np.nan),
+    }
+
+
+def bin_inter_set_distances(layout: FeatureLayout, A: np.ndarray, reference: np.ndarray, grids: list, chunk_size: int = 4096):
+    """
+    Reduces the inter set distances (see iter_inter_set_distances()) of every feature to their linear binning on a grid
+    (mgeval.utils.bin_on_grid()) without holding more than one chunk, e.g. to evaluate their KDE with mgeval.utils.kde_from_bins().
+    Distances to reference vectors that could not be analyzed are left out.
+
+    Args:
+        grids (list): equally spaced grid per feature in the order of the layout, spanning all its distances (see calc_inter_set_distance_stats()),
+                      features with a grid of None are skipped
+
+    Returns:
+        list: bin weights per feature (np.ndarray of the length of its grid), None for skipped features
+    """
+    bins = [None if grid is None else np.zeros(len(grid), dtype=np.float64) for grid in grids]
+    for _, distances in iter_inter_set_distances(layout, A, reference, chunk_size):
+        for i, grid in enumerate(grids):
+            if grid is None:
+                continue
+            values = distances[:, :, i].reshape(-1).astype(np.float64)
+            values = values[np.isfinite(values)]
+            if len(values) > 0:
+                bins[i] += bin_on_grid(values, grid)
+    return bins
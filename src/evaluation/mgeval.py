@@ -1,51 +1,136 @@
+from io import BytesIO
 from typing import List
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
-from pathlib import Path
 from pretty_midi import PrettyMIDI
-from sklearn.model_selection import LeaveOneOut
-from note_seq import NoteSequence, note_sequence_to_pretty_midi, note_sequence_to_midi_file
+from scipy.spatial.distance import pdist, squareform
+from note_seq import NoteSequence, note_sequence_to_pretty_midi
 import midi
 
-from definitions import ROOT_DIR
-from src.io.output import saveMidiFile
 from dependencies.mgeval import core, utils
+from src.evaluation.feature_cache import FeatureCache
 
 
-midi_file_cache = str(ROOT_DIR / Path('midi\\tmp\\mgeval_cache.mid'))
+# bump whenever the analysis results change, this invalidates all cached results
+FEATURE_EXTRACTOR_VERSION = 3
+
+feature_cache = FeatureCache(FEATURE_EXTRACTOR_VERSION)
 
 ###############################
 ###      FULL ANALYSIS      ###
 ###############################
 
-def analyze_sequence(note_seq: NoteSequence, length_in_bars: int = None):
-    note_sequence_to_midi_file(note_seq, midi_file_cache)
+# in-memory sequences (e.g. generated candidates) are usually analyzed once, so they are not written to the persistent feature cache by default,
+# which would otherwise grow by one entry per generated sequence
+def analyze_sequence(note_seq: NoteSequence, length_in_bars: int = None, use_cache: bool = False, features: list = None):
+    pm = note_sequence_to_pretty_midi(note_seq)
+    return __analyze_midi_bytes(__pretty_midi_to_bytes(pm), length_in_bars, use_cache, pm, features)
+
+
+def analyze_pretty_midi(pm: PrettyMIDI, length_in_bars: int = None, use_cache: bool = False, features: list = None):
+    return __analyze_midi_bytes(__pretty_midi_to_bytes(pm), length_in_bars, use_cache, pm, features=features)
+
+
+def analyze_midi_file(midi_file: str, length_in_bars: int = None, use_cache: bool = True, features: list = None):
+    with open(midi_file, 'rb') as f:
+        midi_bytes = f.read()
+    return __analyze_midi_bytes(midi_bytes, length_in_bars, use_cache, features=features)
+
+
+def analyze_pretty_midi_partial(pm: PrettyMIDI, features: list, length_in_bars: int = None, feature: dict = None):
+    """
+    Computes some features of a sequence without the feature cache, keeping the intermediate results (e.g. the parsed midi pattern and note events)
+    for later calls, so the features of a sequence can be computed in steps (e.g. cheap features first) without repeating shared work.
+
+    Args:
+        feature (dict): feature dict returned by the previous call for the same sequence, None for the first call
+
+    Returns:
+        dict: feature name -> value of the requested features, None if the sequence can not be analyzed
+        dict: feature dict with the intermediate results, to be passed to the next call
+    """
+    if feature is None:
+        feature = {'pretty_midi': pm}
+    sources = {'midi_pattern': lambda: midi.read_midifile(BytesIO(__pretty_midi_to_bytes(pm)))}
+    return __analyze(feature, length_in_bars, features=features, sources=sources), feature
+
+
+def analyze_midi_files(midi_files: List[str], length_in_bars: int = None, workers: int = None, chunksize: int = 16, use_cache: bool = True):
+    """
+    Analyzes a list of midi files in a process pool.
+    A file that can not be analyzed is reported in the returned errors and does not abort the batch.
+
+    Args:
+        midi_files (List[str]): paths of the midi files
+        length_in_bars (int): length of the sequences in bars, passed to analyze_midi_file()
+        workers (int): number of worker processes, defaults to the number of CPUs. With 1 the files are analyzed in the current process.
+        chunksize (int): number of files sent to a worker at once
+        use_cache (bool): read and write analysis results from and to the persistent feature cache
+
+    Returns:
+        dict: feature name -> array with one row per file (in the order of midi_files), rows of failed files are NaN,
+              per bar features are padded with empty bars to the largest number of bars
+        dict: file path -> error message for every file that could not be analyzed
+    """
+    tasks = [(midi_file, length_in_bars, use_cache) for midi_file in midi_files]
+
+    if workers == 1:
+        results = [__analyze_midi_file_task(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(__analyze_midi_file_task, tasks, chunksize=chunksize))
+
+    errors = {}
+    for midi_file, (analysis, error) in zip(midi_files, results):
+        if error is not None:
+            errors[midi_file] = error
+
+    features = {}
+    first = next((analysis for analysis, error in results if error is None), None)
+    if first is not None:
+        for key in first:
+            shape = tuple(np.max([np.shape(analysis[key]) for analysis, error in results if error is None], axis=0).astype(int))
+            column = np.full((len(results),) + shape, np.nan)
+            for i, (analysis, error) in enumerate(results):
+                if error is None:
+                    column[i] = __pad_to_shape(analysis[key], shape)
+            features[key] = column
+
+    return features, errors
 
-    feature = {'pretty_midi': note_sequence_to_pretty_midi(note_seq),
-               'midi_pattern': midi.read_midifile(midi_file_cache)}
-    bpm = note_seq.tempos[0].qpm if note_seq.tempos[0].qpm != 0 else 120
-    return __analyze(feature, bpm, length_in_bars)
 
 
-def analyze_pretty_midi(pm: PrettyMIDI, length_in_bars: int = None):
-    saveMidiFile(pm, midi_file_cache, log=False)
+def analyze_pretty_midis(pms: List[PrettyMIDI], length_in_bars: int = None, workers: int = None, chunksize: int = 4, use_cache: bool = False, features: list = None):
+    """
+    Analyzes a list of PrettyMIDI objects in a process pool, like analyze_midi_files(). The sequences are sent to the workers as midi bytes.
 
-    feature = {'pretty_midi': pm,
-               'midi_pattern': midi.read_midifile(midi_file_cache)}
-    tempo_list = feature['pretty_midi'].get_tempo_changes()
-    bpm = next((i for i, x in enumerate(tempo_list) if x != 0), 120)
-    return __analyze(feature, bpm, length_in_bars)
+    Args:
+        workers (int): number of worker processes, defaults to the number of CPUs. With 1 the sequences are analyzed in the current process.
 
+    Returns:
+        list: analysis result per sequence as returned by analyze_pretty_midi(), None for sequences that could not be analyzed
+    """
+    tasks = [(__pretty_midi_to_bytes(pm), length_in_bars, use_cache, features) for pm in pms]
 
-def analyze_midi_file(midi_file: str, length_in_bars: int = None):
-    feature = core.extract_feature(midi_file)
-    tempo_list = feature['pretty_midi'].get_tempo_changes()
-    bpm = next((i for i, x in enumerate(tempo_list) if x != 0), 120)
-    return __analyze(feature, bpm, length_in_bars)
+    if workers == 1 or len(tasks) <= 1:
+        return [__analyze_midi_bytes_task(task) for task in tasks]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(__analyze_midi_bytes_task, tasks, chunksize=chunksize))
 
 
+def __analyze(feature, length_in_bars: int = None, normalize: bool = False, features: list = None, sources: dict = None):
+    """
+    Computes the requested features (all registered features by default) and only the prerequisites they depend on.
 
-def __analyze(feature, bpm: int, length_in_bars: int = None, normalize: bool = False):
+    Args:
+        feature (dict): feature dict for mgeval's core.metrics, must contain the pretty_midi object
+        features (list): names of the features to compute, see feature_registry
+        sources (dict): prerequisite name -> function returning it, for midi sources that are only parsed when needed (e.g. 'midi_pattern')
+
+    Returns:
+        dict: feature name -> value, in the order of feature_registry
+    """
     try:
         feature['pretty_midi'].instruments[0]
     except IndexError:
@@ -53,64 +138,289 @@ def __analyze(feature, bpm: int, length_in_bars: int = None, normalize: bool = F
         return None
 
     metrics = core.metrics()
- 
-    return {
-        'pitch_count': metrics.total_used_pitch(feature),
-        # 'pitch_count_per_bar': metrics.bar_used_pitch(feature, 1, length_in_bars), # CHECK calculation in core seems to return wrong results
-        'pitch_class_histogram': metrics.total_pitch_class_histogram(feature),
-        # 'pitch_class_histogram_per_bar': metrics.bar_pitch_class_histogram(feature, 0, bpm, length_in_bars), # CHECK only works when length in bars is given, should have reliable calculation here
-        'pitch_class_transition_matrix': metrics.pitch_class_transition_matrix(feature),
-        'avg_pitch_interval': metrics.avg_pitch_shift(feature),
-        'pitch_range': metrics.pitch_range(feature),
-
-        'note_count': metrics.total_used_note(feature),
-        # 'note_count_per_bar': metrics.bar_used_note(feature, 1, length_in_bars), # CHECK calculation in core seems to return wrong results
-        'note_length_histogram': metrics.note_length_hist(feature, pause_event=True),
-        'note_length_transition_matrix': metrics.note_length_transition_matrix(feature, pause_event=True),
-        'avg_ioi': metrics.avg_IOI(feature),
-        'ioi_histogram': metrics.ioi_hist(feature),
-        'ioi_transition_matrix': metrics.ioi_transition_matrix(feature),
-    }
+    names = __select_features(features)
+
+    resolved = set()
+    for name in names:
+        __resolve_prerequisites(feature_registry[name][0], feature, length_in_bars, sources or {}, resolved)
+
+    return {name: feature_registry[name][1](metrics, feature, length_in_bars) for name in names}
+
+
+###############################
+###    FEATURE REGISTRY     ###
+###############################
+
+# intermediate results shared between features: name -> (prerequisites, function adding the result to the feature dict)
+# the midi sources have no function, they are either part of the feature dict already or parsed lazily from the sources passed to __analyze()
+feature_prerequisites = {
+    'pretty_midi': ([], None),
+    'midi_pattern': ([], None),
+    'note_array': (['pretty_midi'], lambda feature, length_in_bars: core.extract_note_array(feature)),
+    'pitch_weights': (['note_array'], lambda feature, length_in_bars: core.extract_pitch_weights(feature)),
+    'bar_segments': (['note_array'], lambda feature, length_in_bars: core.extract_bar_segments(feature, length_in_bars)),
+    'note_events': (['midi_pattern'], lambda feature, length_in_bars: core.extract_note_events(feature)),
+}
+
+# available features: name -> (prerequisites, function computing the value from core.metrics, the feature dict and the length in bars)
+feature_registry = {
+    'pitch_count': (['pitch_weights'], lambda metrics, feature, length_in_bars: metrics.total_used_pitch(feature)),
+    'pitch_count_per_bar': (['bar_segments'], lambda metrics, feature, length_in_bars: metrics.bar_used_pitch(feature, length_in_bars)),
+    'pitch_class_histogram': (['pitch_weights'], lambda metrics, feature, length_in_bars: metrics.total_pitch_class_histogram(feature)),
+    'pitch_class_histogram_per_bar': (['bar_segments'], lambda metrics, feature, length_in_bars: metrics.bar_pitch_class_histogram(feature, length_in_bars)),
+    'pitch_class_transition_matrix': (['pretty_midi'], lambda metrics, feature, length_in_bars: metrics.pitch_class_transition_matrix(feature)),
+    'avg_pitch_interval': (['note_events'], lambda metrics, feature, length_in_bars: metrics.avg_pitch_shift(feature)),
+    'pitch_range': (['pitch_weights'], lambda metrics, feature, length_in_bars: metrics.pitch_range(feature)),
+
+    'note_count': (['note_events'], lambda metrics, feature, length_in_bars: metrics.total_used_note(feature)),
+    'note_count_per_bar': (['bar_segments'], lambda metrics, feature, length_in_bars: metrics.bar_used_note(feature, length_in_bars)),
+    'note_length_histogram': (['note_events'], lambda metrics, feature, length_in_bars: metrics.note_length_hist(feature, pause_event=True)),
+    'note_length_transition_matrix': (['note_events'], lambda metrics, feature, length_in_bars: metrics.note_length_transition_matrix(feature, pause_event=True)),
+    'avg_ioi': (['pretty_midi'], lambda metrics, feature, length_in_bars: metrics.avg_IOI(feature)),
+    'ioi_histogram': (['note_events'], lambda metrics, feature, length_in_bars: metrics.ioi_hist(feature)),
+    'ioi_transition_matrix': (['note_events'], lambda metrics, feature, length_in_bars: metrics.ioi_transition_matrix(feature)),
+}
+
+
+def __select_features(features: list = None):
+    """
+    Returns the names of the requested features in the order of feature_registry, unknown names are ignored.
+    """
+    if features is None:
+        return list(feature_registry)
+    return [name for name in feature_registry if name in features]
+
+
+def __resolve_prerequisites(names: list, feature: dict, length_in_bars: int, sources: dict, resolved: set):
+    """
+    Adds the given prerequisites and everything they depend on to the feature dict, each one only once.
+    """
+    for name in names:
+        if name in resolved:
+            continue
+        requires, extract = feature_prerequisites[name]
+        __resolve_prerequisites(requires, feature, length_in_bars, sources, resolved)
+        if extract is not None:
+            extract(feature, length_in_bars)
+        elif name not in feature:
+            feature[name] = sources[name]()
+        resolved.add(name)
 
 
 ###############################
 ###   DISTANCE CALCULATION  ###
 ###############################
 
-def calc_distances(metrics1: dict, metrics2: dict):
+# distance metrics available for the comparison of feature values, mapped to the modes of mgeval.utils.c_dist
+distance_metrics = {
+    'euclidean': 'None',
+    'EMD': 'EMD',
+    'KL': 'KL',
+}
+
+
+def calc_distances(metrics1: dict, metrics2: dict, metric: str = 'euclidean'):
+    """
+    Calculates the distance between the values of each feature of two sequences.
+    Per bar features of sequences with a different number of bars are compared as if the shorter sequence ended with empty bars.
+
+    Args:
+        metric (str): one of distance_metrics, 'KL' is the divergence of the second from the first sequence
+    """
+    mode = distance_metrics[metric]
     distances = {}
 
     for key in metrics1:
-        distances[key] = np.linalg.norm(metrics1[key] - metrics2[key])
+        value1 = np.asarray(metrics1[key])
+        value2 = np.asarray(metrics2[key])
+        if value1.shape != value2.shape:
+            shape = np.maximum(value1.shape, value2.shape)
+            value1 = __pad_to_shape(value1, shape)
+            value2 = __pad_to_shape(value2, shape)
+        if mode == 'None':
+            distances[key] = np.linalg.norm(value1 - value2)
+        else:
+            distances[key] = utils.c_dist(value1, value2[np.newaxis], mode)[0]
     return distances
 
 
+def calc_distances_one_to_many(metrics: dict, list_of_metrics: List[dict], metric: str = 'euclidean'):
+    """
+    Calculates the distances between the feature values of one sequence and each sequence of a list (like calc_distances() for every pair),
+    with one vectorized distance computation per feature.
+    Per bar features are padded to the largest number of bars of all sequences, so with metric='EMD' or 'KL' they can differ from calc_distances().
+
+    Args:
+        metrics (dict): analysis result of the sequence
+        list_of_metrics (List[dict]): analysis results of the sequences it is compared with, None for sequences that could not be analyzed
+
+    Returns:
+        list: feature names (the keys of metrics)
+        np.ndarray: shape (len(list_of_metrics), number of features), distances per sequence and feature, NaN rows for sequences that are None
+    """
+    mode = distance_metrics[metric]
+    names = list(metrics.keys())
+    analyzed = [i for i, other in enumerate(list_of_metrics) if other is not None]
+    distances = np.full((len(list_of_metrics), len(names)), np.nan)
+    if len(analyzed) == 0:
+        return names, distances
+
+    for j, key in enumerate(names):
+        values = __stack_feature_values([metrics[key]] + [list_of_metrics[i][key] for i in analyzed])
+        distances[analyzed, j] = utils.c_dist_pairwise(values[:1], values[1:], mode)[0]
+    return names, distances
+
+
 def calc_intra_set_distances(list_of_sequences: List[dict]):
+    """
+    Calculates the distances between all sequences of a set for each feature.
+    Only the upper triangle of each pairwise distance matrix is computed.
+
+    Returns:
+        np.ndarray: shape (num_samples, num_metrics, num_samples-1), distances of each sample to all other samples
+    """
     set_of_sequences = __list_of_dicts_to_dict_of_lists(list_of_sequences)
-    #max_key = max(set_of_sequences, key= lambda x: len(set(set_of_sequences[x])))
 
     num_samples = len(list_of_sequences)
     num_metrics = len(set_of_sequences)
 
-    loo = LeaveOneOut()
-    loo.get_n_splits(np.arange(num_samples))
     intra_set_distances = np.zeros((num_samples, num_metrics, num_samples-1))
+    off_diagonal = ~np.eye(num_samples, dtype=bool)
 
-    i = 0
-    for key in set_of_sequences:
-        for train_indexes, test_index in loo.split(np.arange(num_samples)):
-            x = utils.c_dist(np.array(set_of_sequences[key])[test_index], np.array(set_of_sequences[key])[train_indexes])
-            intra_set_distances[test_index[0]][i] = x
-        i += 1
+    for i, key in enumerate(set_of_sequences):
+        values = __stack_feature_values(set_of_sequences[key])
+        distance_matrix = squareform(pdist(values)) if num_samples > 1 else np.zeros((num_samples, num_samples))
+        intra_set_distances[:, i, :] = distance_matrix[off_diagonal].reshape(num_samples, num_samples-1)
 
     return intra_set_distances
 
 
+def calc_avg_intra_set_distances(list_of_sequences: List[dict], chunk_size: int = 256, metric: str = 'euclidean'):
+    """
+    Calculates the average distance between all pairs of sequences of a set for each feature.
+    The upper triangle of each pairwise distance matrix is computed in blocks of chunk_size rows, so the distance blocks stay in O(chunk_size * num_samples)
+    memory besides the stacked feature values. With metric='EMD' or 'KL' the values of each pair are compared elementwise, utils.c_dist_pairwise()
+    splits these comparisons into sub-blocks of at most 2^22 elements, so long per bar features do not grow a block to chunk_size * num_samples * values.
+    The KL divergence is not symmetric, with metric='KL' the average is taken over both directions of each pair.
+    Per bar features are padded to the largest number of bars in the set, so with metric='EMD' they can differ from calc_distances() of single pairs.
+
+    Returns:
+        dict: average intra set distance per feature, NaN for sets with less than 2 sequences
+    """
+    set_of_sequences = __list_of_dicts_to_dict_of_lists(list_of_sequences)
+    num_samples = len(list_of_sequences)
+    num_pairs = num_samples * (num_samples-1) / 2
+
+    result = {}
+    for key in set_of_sequences:
+        values = __stack_feature_values(set_of_sequences[key])
+        total = 0.
+        if metric == 'KL':
+            for start in range(0, num_samples, chunk_size):
+                block = utils.c_dist_pairwise(values[start:start+chunk_size], values, 'KL')
+                block[np.arange(len(block)), start + np.arange(len(block))] = 0
+                total += np.sum(block) / 2
+        else:
+            for start in range(0, num_samples-1, chunk_size):
+                stop = min(start + chunk_size, num_samples-1)
+                block = utils.c_dist_pairwise(values[start:stop], values[start+1:], distance_metrics[metric])
+                upper = np.arange(start+1, num_samples)[np.newaxis, :] > np.arange(start, stop)[:, np.newaxis]
+                total += np.sum(block[upper])
+        result[key] = total / num_pairs if num_pairs > 0 else np.nan
+
+    return result
+
+
 
 ###############################
 ###        UTILITIES        ###
 ###############################
 
+def __analyze_midi_file_task(task: tuple):
+    """
+    Worker function of analyze_midi_files(). Never raises, returns a tuple of (analysis, error message).
+    """
+    midi_file, length_in_bars, use_cache = task
+    try:
+        analysis = analyze_midi_file(midi_file, length_in_bars, use_cache)
+    except Exception as e:
+        return None, type(e).__name__ + ': ' + str(e)
+    if analysis is None:
+        return None, 'Midi file is empty and can not be analyzed'
+    return analysis, None
+
+
+def __analyze_midi_bytes_task(task: tuple):
+    """
+    Worker function of analyze_pretty_midis(). Returns None if the sequence can not be analyzed.
+    """
+    midi_bytes, length_in_bars, use_cache, features = task
+    try:
+        return __analyze_midi_bytes(midi_bytes, length_in_bars, use_cache, features=features)
+    except Exception as e:
+        print('[EVAL] Error: Sequence could not be analyzed - ' + type(e).__name__ + ': ' + str(e))
+        return None
+
+
+def __analyze_midi_bytes(midi_bytes: bytes, length_in_bars: int = None, use_cache: bool = True, pm: PrettyMIDI = None, features: list = None):
+    """
+    Analyzes a midi file given as bytes, results are read from and written to the feature cache if use_cache is set.
+    Only features missing in the cache entry are computed, and merged into the entry.
+    The feature dict expected by mgeval's core.metrics is parsed from in-memory buffers, so no temporary file is shared between calls.
+    The midi pattern is only parsed if one of the requested features needs it.
+    """
+    names = __select_features(features)
+    cached = {}
+    if use_cache:
+        key = feature_cache.key(midi_bytes, length_in_bars)
+        cached = feature_cache.load(key) or {}
+        if all(name in cached for name in names):
+            return {name: cached[name] for name in names}
+
+    if pm is None:
+        pm = PrettyMIDI(BytesIO(midi_bytes))
+    feature = {'pretty_midi': pm}
+    sources = {'midi_pattern': lambda: midi.read_midifile(BytesIO(midi_bytes))}
+
+    missing = [name for name in names if name not in cached]
+    analysis = __analyze(feature, length_in_bars, features=missing, sources=sources)
+    if analysis is None:
+        return None
+    if use_cache:
+        cached.update(analysis)
+        feature_cache.store(key, cached)
+    return {name: cached[name] if name in cached else analysis[name] for name in names}
+
+
+def __pretty_midi_to_bytes(pm: PrettyMIDI):
+    buffer = BytesIO()
+    pm.write(buffer)
+    return buffer.getvalue()
+
+
+def __stack_feature_values(values: list):
+    """
+    Stacks the values of one feature into a 2D float array with one flattened row per sequence.
+    Per bar features are padded with empty bars to the largest number of bars.
+    """
+    shapes = [np.shape(value) for value in values]
+    if len(set(shapes)) > 1:
+        shape = np.max(shapes, axis=0)
+        values = [__pad_to_shape(value, shape) for value in values]
+    values = np.asarray(values, dtype=np.float64)
+    return values.reshape(len(values), -1)
+
+
+def __pad_to_shape(value, shape):
+    """
+    Pads a feature value with zeros at the end of each axis, e.g. a per bar feature with empty bars.
+    """
+    value = np.asarray(value, dtype=np.float64)
+    if value.shape == tuple(shape):
+        return value
+    return np.pad(value, [(0, int(target) - size) for size, target in zip(value.shape, shape)], mode='constant')
+
+
 def __list_of_dicts_to_dict_of_lists(sequences: List[dict]):
     result = {}
     for dictionary in sequences:
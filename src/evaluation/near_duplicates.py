@@ -0,0 +1,122 @@
+import numpy as np
+from pretty_midi import PrettyMIDI
+
+# prime of the universal hash functions (a * x + b) mod p of the min hash signatures, below 2^32 so that a * x + b fits into uint64
+HASH_PRIME = 4294967291
+
+
+class NearDuplicateIndex():
+    """
+    Locality-sensitive hashing index for near-duplicate melodies.
+    Each sequence is represented by the set of its notes quantized to 16th steps (pitch, onset, duration). The set is summarized by a min hash signature,
+    whose bands are hashed into buckets, so only sequences that share a bucket are compared exactly (Jaccard similarity of the note sets).
+    Adding and querying a sequence takes roughly constant time, flagging the duplicates of a set of n sequences roughly linear time.
+    """
+
+    def __init__(self, threshold: float = 0.8, num_bands: int = 16, rows_per_band: int = 4, seed: int = 0):
+        """
+        Args:
+            threshold (float): minimum Jaccard similarity of the quantized notes for two sequences to count as near-duplicates
+            num_bands (int), rows_per_band (int): LSH banding of the min hash signature, pairs with a similarity above (1/num_bands)^(1/rows_per_band)
+                                                  share a bucket with high probability
+            seed (int): seed of the hash functions
+        """
+        self.threshold = threshold
+        self.num_bands = num_bands
+        self.rows_per_band = rows_per_band
+        rng = np.random.default_rng(seed)
+        num_hashes = num_bands * rows_per_band
+        self.__a = rng.integers(1, HASH_PRIME, num_hashes, dtype=np.uint64)
+        self.__b = rng.integers(0, HASH_PRIME, num_hashes, dtype=np.uint64)
+        self.__buckets = [{} for _ in range(num_bands)]
+        self.__note_sets = []
+
+
+    def __len__(self):
+        return len(self.__note_sets)
+
+
+    def query(self, sequence: PrettyMIDI):
+        """
+        Returns:
+            int: index of the most similar near-duplicate in the index, None if there is none
+        """
+        return self.__query(self.__quantize(sequence))[0]
+
+
+    def add(self, sequence: PrettyMIDI):
+        """
+        Adds a sequence to the index.
+
+        Returns:
+            int: index of the sequence in the index
+            int: index of the most similar near-duplicate added before, None if there is none
+        """
+        notes = self.__quantize(sequence)
+        duplicate_of, signature = self.__query(notes)
+
+        index = len(self.__note_sets)
+        self.__note_sets.append(notes)
+        for band, key in enumerate(self.__band_keys(signature)):
+            self.__buckets[band].setdefault(key, []).append(index)
+        return index, duplicate_of
+
+
+    def find_near_duplicates(self, sequences: list):
+        """
+        Adds a list of sequences to the index and flags the near-duplicates.
+
+        Returns:
+            list: for each sequence the index of the near-duplicate it repeats (in the index), None for sequences that are not near-duplicates
+        """
+        return [self.add(sequence)[1] for sequence in sequences]
+
+
+    def __query(self, notes: np.ndarray):
+        signature = self.__signature(notes)
+        candidates = set()
+        for band, key in enumerate(self.__band_keys(signature)):
+            candidates.update(self.__buckets[band].get(key, []))
+
+        best, best_similarity = None, 0.
+        for candidate in sorted(candidates):
+            similarity = self.__jaccard(notes, self.__note_sets[candidate])
+            if similarity >= self.threshold and similarity > best_similarity:
+                best, best_similarity = candidate, similarity
+        return best, signature
+
+
+    def __quantize(self, sequence: PrettyMIDI):
+        """
+        Returns:
+            np.ndarray: sorted unique note tokens, one int64 per note combining pitch, onset and duration in 16th steps
+        """
+        notes = [note for instrument in sequence.instruments if not instrument.is_drum for note in instrument.notes]
+        if len(notes) == 0:
+            return np.zeros(0, dtype=np.int64)
+        steps_per_tick = 4. / sequence.resolution
+        onset = np.array([sequence.time_to_tick(note.start) for note in notes]) * steps_per_tick
+        offset = np.array([sequence.time_to_tick(note.end) for note in notes]) * steps_per_tick
+        pitch = np.array([note.pitch for note in notes], dtype=np.int64)
+        onset = np.round(onset).astype(np.int64)
+        duration = np.maximum(np.round(offset).astype(np.int64) - onset, 0)
+        return np.unique(pitch | (onset << 7) | (np.minimum(duration, (1 << 20) - 1) << 27))
+
+
+    def __signature(self, notes: np.ndarray):
+        if len(notes) == 0:
+            return np.full(len(self.__a), HASH_PRIME, dtype=np.uint64)
+        x = (notes.astype(np.uint64) % np.uint64(HASH_PRIME))[:, np.newaxis]
+        hashes = (self.__a * x + self.__b) % np.uint64(HASH_PRIME)
+        return np.min(hashes, axis=0)
+
+
+    def __band_keys(self, signature: np.ndarray):
+        return [signature[band * self.rows_per_band:(band + 1) * self.rows_per_band].tobytes() for band in range(self.num_bands)]
+
+
+    def __jaccard(self, notes1: np.ndarray, notes2: np.ndarray):
+        if len(notes1) == 0 and len(notes2) == 0:
+            return 1.
+        intersection = len(np.intersect1d(notes1, notes2, assume_unique=True))
+        return intersection / float(len(notes1) + len(notes2) - intersection)
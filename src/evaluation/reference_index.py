@@ -0,0 +1,133 @@
+import numpy as np
+
+from src.evaluation.feature_vectors import FeatureLayout, calc_packed_distances
+
+
+class ReferenceCallIndex():
+    """
+    Nearest-neighbour index over the packed feature vectors of the calls of a reference set.
+    The distance between two calls is the weighted sum of the euclidean distances of their features (like the average of mgeval.calc_distances()),
+    so the most similar calls are found by a vectorized brute-force scan: every feature segment of the reference calls is stored contiguously
+    with its squared norms, and the distances of a feature to all calls are computed via ||a||^2 + ||b||^2 - 2ab with a single matrix-vector product.
+    The best candidates of the scan are re-ranked with the exact distances.
+    """
+
+    def __init__(self, layout: FeatureLayout, calls: np.ndarray, responses: np.ndarray = None, weights=None,
+                 call_files: list = None, response_files: list = None, candidate_factor: int = 4):
+        """
+        Args:
+            layout (FeatureLayout): layout of the packed vectors
+            calls (np.ndarray): packed call vectors of shape (number of pairs, layout.size), e.g. as returned by db.reference_features.load_reference_features()
+            responses (np.ndarray): packed response vectors in the same order, can be memory-mapped, only read for the neighbours of a query
+            weights (dict or np.ndarray): weight per feature (by name or in the order of the layout), e.g. 1 / (normalization factor * number of features).
+                                          By default each feature is scaled by the spread of the reference calls, so all features count about the same.
+            call_files (list), response_files (list): paths of the reference midi files in the same order
+            candidate_factor (int): number of candidates per requested neighbour that are re-ranked with the exact distances
+        """
+        self.layout = layout
+        self.responses = responses
+        self.call_files = call_files
+        self.response_files = response_files
+        self.candidate_factor = candidate_factor
+
+        calls = np.asarray(calls, dtype=np.float32).reshape(-1, layout.size)
+        valid = ~np.isnan(calls).any(axis=1)
+        # rows of the reference set that can be found, calls that could not be analyzed are left out
+        self.__rows = np.flatnonzero(valid)
+        self.__segments = [np.ascontiguousarray(calls[valid, offset:offset + size]) for offset, size in zip(layout.offsets, layout.sizes)]
+        self.__squared_norms = [np.einsum('ij,ij->i', segment, segment, dtype=np.float64) for segment in self.__segments]
+
+        if weights is None:
+            weights = self.__spread_weights()
+        elif isinstance(weights, dict):
+            weights = layout.weight_vector(weights)
+        self.weights = np.asarray(weights, dtype=np.float64)
+
+
+    def __len__(self):
+        return len(self.__rows)
+
+
+    def query(self, analysis: dict, k: int = 10):
+        """
+        Finds the k reference calls most similar to a call.
+
+        Args:
+            analysis (dict): analysis result of the call as returned by mgeval.analyze_*() (with the number of bars of the layout),
+                             features missing in the analysis are ignored
+            k (int): number of neighbours
+
+        Returns:
+            dict: in the form of {'indices': rows of the neighbours in the reference set, 'distances': weighted distance of each neighbour,
+                                  'call_files': ..., 'response_files': ..., 'responses': packed response vectors of the neighbours},
+                  sorted by distance, entries without data are None
+        """
+        return self.query_vector(self.layout.pack(analysis), k)
+
+
+    def query_vector(self, vector: np.ndarray, k: int = 10):
+        """
+        Same as query() for a packed call vector.
+        """
+        vector = np.asarray(vector, dtype=np.float64)
+        segments = [vector[offset:offset + size] for offset, size in zip(self.layout.offsets, self.layout.sizes)]
+        features = [i for i, segment in enumerate(segments) if not np.isnan(segment).any()]
+        k = min(k, len(self))
+
+        scores = np.zeros(len(self), dtype=np.float64)
+        for i in features:
+            if self.weights[i] == 0:
+                continue
+            cross = self.__segments[i] @ segments[i].astype(np.float32)
+            squared = self.__squared_norms[i] + np.dot(segments[i], segments[i]) - 2 * cross
+            scores += self.weights[i] * np.sqrt(np.maximum(squared, 0))
+
+        num_candidates = min(len(self), k * self.candidate_factor)
+        if num_candidates < len(self):
+            candidates = np.argpartition(scores, num_candidates - 1)[:num_candidates]
+        else:
+            candidates = np.arange(len(self))
+        exact = np.zeros(len(candidates), dtype=np.float64)
+        for i in features:
+            diff = self.__segments[i][candidates].astype(np.float64) - segments[i]
+            exact += self.weights[i] * np.sqrt(np.einsum('ij,ij->i', diff, diff))
+
+        order = np.argsort(exact, kind='stable')[:k]
+        indices = self.__rows[candidates[order]]
+        return {
+            'indices': indices,
+            'distances': exact[order],
+            'call_files': None if self.call_files is None else [self.call_files[i] for i in indices],
+            'response_files': None if self.response_files is None else [self.response_files[i] for i in indices],
+            'responses': None if self.responses is None else np.asarray(self.responses[indices]),
+        }
+
+
+    def evaluate_response(self, analysis: dict, neighbours: dict):
+        """
+        Compares a (generated) response with the real responses to the neighbours of its call.
+
+        Args:
+            analysis (dict): analysis result of the response as returned by mgeval.analyze_*()
+            neighbours (dict): result of query() for the call
+
+        Returns:
+            dict: feature name -> np.ndarray with the euclidean distance to the response of each neighbour (like mgeval.calc_distances())
+        """
+        distances = calc_packed_distances(self.layout, self.layout.pack(analysis), neighbours['responses'])
+        return {name: distances[:, i] for i, name in enumerate(self.layout.names)}
+
+
+    def __spread_weights(self):
+        """
+        Returns:
+            np.ndarray: 1 / (number of features * root mean squared distance of the reference calls to their mean) per feature, 0 for constant features
+        """
+        spread = np.zeros(len(self.layout), dtype=np.float64)
+        if len(self) > 0:
+            for i, (segment, squared_norms) in enumerate(zip(self.__segments, self.__squared_norms)):
+                mean = np.mean(segment, axis=0, dtype=np.float64)
+                spread[i] = np.sqrt(max(np.mean(squared_norms) - np.dot(mean, mean), 0.))
+        weights = np.zeros(len(self.layout), dtype=np.float64)
+        weights[spread > 0] = 1. / (len(self.layout) * spread[spread > 0])
+        return weights
@@ -0,0 +1,128 @@
+import numpy as np
+from pretty_midi import PrettyMIDI
+from scipy.spatial.distance import cdist
+
+from src.evaluation.mgeval import analyze_pretty_midi
+
+
+class VarianceTracker():
+    """
+    Keeps the feature values and pairwise feature distances of a growing set of sequences.
+    Adding the (n+1)th sequence only computes its n distances to the sequences added before,
+    the average intra set distances of the whole set or any subset are then read from the cached distance matrices.
+    """
+
+    def __init__(self, initial_capacity: int = 16):
+        self.keys = None
+        self.tags = []
+        self.__capacity = initial_capacity
+        self.__size = 0
+        self.__values = {}
+        self.__distances = {}
+
+
+    def __len__(self):
+        return self.__size
+
+
+    def add(self, sequence: PrettyMIDI, tag: str = None, use_cache: bool = False):
+        """
+        Analyzes a sequence and adds it to the set.
+
+        Args:
+            sequence (PrettyMIDI): sequence to add
+            tag (str): optional label (e.g. 'generation' or 'adaptation') that can be used to query the variance of a subset
+            use_cache (bool): read and write the analysis from and to the persistent feature cache (see mgeval.analyze_pretty_midi())
+
+        Returns:
+            int: index of the sequence in the set, None if it could not be analyzed
+        """
+        return self.add_analysis(analyze_pretty_midi(sequence, use_cache=use_cache), tag)
+
+
+    def add_analysis(self, analysis: dict, tag: str = None):
+        """
+        Adds a sequence to the set given its analysis as returned by mgeval.analyze_*().
+
+        Returns:
+            int: index of the sequence in the set, None if the analysis is None
+        """
+        if analysis is None:
+            print('[EVAL] Error: Sequence could not be analyzed and is not added to the variance tracker.')
+            return None
+
+        if self.keys is None:
+            self.keys = list(analysis.keys())
+            for key in self.keys:
+                dimensions = np.size(analysis[key])
+                self.__values[key] = np.zeros((self.__capacity, dimensions))
+                self.__distances[key] = np.zeros((self.__capacity, self.__capacity))
+        elif self.__size == self.__capacity:
+            self.__grow()
+
+        index = self.__size
+        for key in self.keys:
+            value = np.asarray(analysis[key], dtype=np.float64).reshape(1, -1)
+            # per bar features of sequences with a different number of bars: the shorter one is padded with empty bars
+            if value.shape[1] > self.__values[key].shape[1]:
+                self.__values[key] = np.pad(self.__values[key], ((0, 0), (0, value.shape[1] - self.__values[key].shape[1])), mode='constant')
+            elif value.shape[1] < self.__values[key].shape[1]:
+                value = np.pad(value, ((0, 0), (0, self.__values[key].shape[1] - value.shape[1])), mode='constant')
+            distances = cdist(value, self.__values[key][:index])[0]
+            self.__values[key][index] = value
+            self.__distances[key][index, :index] = distances
+            self.__distances[key][:index, index] = distances
+
+        self.tags.append(tag)
+        self.__size += 1
+        return index
+
+
+    def distance_matrix(self, key: str, indices: list = None, tag: str = None):
+        """
+        Returns:
+            np.ndarray: pairwise distances of a feature between the selected sequences (all sequences by default)
+        """
+        selection = self.__select(indices, tag)
+        return self.__distances[key][np.ix_(selection, selection)]
+
+
+    def avg_distances(self, indices: list = None, tag: str = None):
+        """
+        Calculates the average distance between all pairs of the selected sequences for each feature.
+        Sequences are selected by their indices (e.g. range(k) for the first k) or by tag, all sequences are used by default.
+
+        Returns:
+            dict: average intra set distance per feature, NaN if less than 2 sequences are selected
+        """
+        selection = self.__select(indices, tag)
+        num_samples = len(selection)
+        result = {}
+
+        for key in self.keys or []:
+            if num_samples < 2:
+                result[key] = np.nan
+            else:
+                total = np.sum(self.__distances[key][np.ix_(selection, selection)])
+                result[key] = total / (num_samples * (num_samples-1))
+
+        return result
+
+
+    def __select(self, indices: list = None, tag: str = None):
+        selection = np.arange(self.__size) if indices is None else np.asarray(indices, dtype=int)
+        if tag is not None:
+            selection = selection[[self.tags[i] == tag for i in selection]]
+        return selection
+
+
+    def __grow(self):
+        self.__capacity *= 2
+        for key in self.keys:
+            values = np.zeros((self.__capacity, self.__values[key].shape[1]))
+            values[:self.__size] = self.__values[key][:self.__size]
+            self.__values[key] = values
+
+            distances = np.zeros((self.__capacity, self.__capacity))
+            distances[:self.__size, :self.__size] = self.__distances[key][:self.__size, :self.__size]
+            self.__distances[key] = distances
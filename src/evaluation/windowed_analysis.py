@@ -0,0 +1,327 @@
+from io import BytesIO
+
+import numpy as np
+from pretty_midi import PrettyMIDI
+import midi
+
+from dependencies.mgeval import core
+from src.evaluation.mgeval import feature_registry
+
+# features computed from the midi pattern, which is only parsed if one of them is requested
+rhythm_features = ['avg_pitch_interval', 'note_count', 'note_length_histogram', 'note_length_transition_matrix', 'ioi_histogram', 'ioi_transition_matrix']
+
+
+###############################
+###    WINDOWED ANALYSIS    ###
+###############################
+
+def analyze_windows(pm: PrettyMIDI, window_bars: int = 4, hop_bars: int = 1, features: list = None):
+    """
+    Computes the mgeval features of every window of window_bars bars of a long sequence (e.g. a full song), moving the window by hop_bars bars.
+    A window contains the notes starting in its bars, like the excerpts written by utils.sequence_extraction, but no excerpt is analyzed on its own:
+    every note contributes to the histograms and counts once, transitions between two notes once, and while the window slides only the contributions
+    of the notes that enter and leave it are added and subtracted.
+
+    For monophonic melodies the features equal those of the excerpts, except for the per bar features: they are the rows of the whole sequence,
+    so they include the parts of notes that sound into a window from an earlier bar. Transitions and intervals between overlapping notes
+    at the window boundaries can differ, and all features use the notes of the first instrument. Pitch count, pitch class histogram and pitch range
+    weight the notes by their exact durations (core.extract_pitch_weights() with fs=None), not by the frames of a 100 Hz piano roll, so notes
+    shorter than one frame count here, and sustain pedal and pitch bends are ignored.
+
+    Args:
+        pm (PrettyMIDI): the sequence
+        window_bars (int): length of the windows in bars
+        hop_bars (int): distance between the starts of two consecutive windows in bars
+        features (list): names of the features to compute, see mgeval.feature_registry
+
+    Returns:
+        dict: feature name -> array with one row per window (in the shape returned by mgeval.analyze_*() with length_in_bars=window_bars),
+              rows of windows without notes are NaN
+        np.ndarray: first bar of every window
+    """
+    try:
+        pm.instruments[0]
+    except IndexError:
+        print('[EVAL] Error: Midi file is empty and can not be analyzed')
+        return None, None
+
+    names = [name for name in feature_registry if features is None or name in features]
+    feature = {'pretty_midi': pm}
+
+    bar_lines = core.extract_bar_lines(feature)
+    num_windows = max(len(bar_lines) - 1 - window_bars, 0) // hop_bars + 1
+    window_start = np.arange(num_windows) * hop_bars
+    bar_lines = core.extract_bar_lines(feature, int(window_start[-1]) + window_bars)
+    window_time = np.stack((bar_lines[window_start], bar_lines[window_start + window_bars]), axis=1)
+
+    result = {}
+    result.update(__pitch_features(feature, names, window_time))
+    result.update(__per_bar_features(feature, names, window_start, window_bars))
+    if any(name in names for name in rhythm_features):
+        buffer = BytesIO()
+        pm.write(buffer)
+        feature['midi_pattern'] = midi.read_midifile(BytesIO(buffer.getvalue()))
+        result.update(__rhythm_features(feature, names, window_time))
+
+    # windows without notes can not be analyzed
+    windows = __note_ranges(np.sort(core.extract_note_array(feature)[:, 2]), window_time)
+    is_empty = windows[:, 0] == windows[:, 1]
+    for name in result:
+        result[name] = np.asarray(result[name], dtype=np.float64)
+        result[name][is_empty] = np.nan
+
+    return {name: result[name] for name in names}, window_start
+
+
+def analyze_midi_file_windows(midi_file: str, window_bars: int = 4, hop_bars: int = 1, features: list = None):
+    """
+    Computes the mgeval features of every window of a midi file, see analyze_windows().
+    """
+    return analyze_windows(PrettyMIDI(midi_file), window_bars, hop_bars, features)
+
+
+###############################
+###   FEATURE COMPUTATION   ###
+###############################
+
+def __pitch_features(feature: dict, names: list, window_time: np.ndarray):
+    """
+    Features computed from the notes of the pretty_midi object: pitch count, pitch class histogram, pitch class transition matrix, pitch range and average ioi.
+    """
+    notes = core.extract_note_array(feature)
+    notes = notes[np.argsort(notes[:, 2], kind='stable')]
+    pitch, start, end = notes[:, 0].astype(np.int64), notes[:, 2], notes[:, 3]
+    windows = __note_ranges(start, window_time)
+    note_index = np.arange(len(notes))
+    result = {}
+
+    if any(name in names for name in ['pitch_count', 'pitch_class_histogram', 'pitch_range']):
+        weight = notes[:, 1] * np.maximum(end - start, 0)
+        sounding = weight > 0
+        # number of sounding notes and their weights per pitch, a pitch is used while it has sounding notes (which also cancels rounding errors of the weights)
+        counts = __window_sums(note_index[sounding], note_index[sounding], pitch[sounding], np.ones(np.sum(sounding)), 128, windows)
+        weights = __window_sums(note_index, note_index, pitch, weight, 128, windows)
+        weights[counts == 0] = 0
+        used = counts > 0
+
+        result['pitch_count'] = np.sum(used, axis=1)
+        histogram = weights.reshape(-1, 128) @ (np.arange(128)[:, np.newaxis] % 12 == np.arange(12)).astype(np.float64)
+        result['pitch_class_histogram'] = histogram / np.sum(histogram, axis=1, keepdims=True)
+        highest = 127 - np.argmax(used[:, ::-1], axis=1)
+        lowest = np.argmax(used, axis=1)
+        result['pitch_range'] = np.where(np.any(used, axis=1), highest - lowest, 0)
+
+    if 'pitch_class_transition_matrix' in names:
+        # like PrettyMIDI.get_pitch_class_transition_matrix(): a transition from every note to every note starting within 0.05 seconds of its end
+        first = np.searchsorted(start, end - 0.05, side='right')
+        last = np.searchsorted(start, end + 0.05, side='left')
+        count = np.maximum(last - first, 0)
+        source = np.repeat(note_index, count)
+        target = np.arange(np.sum(count)) - np.repeat(np.cumsum(count) - count, count) + np.repeat(first, count)
+        is_close = np.abs(end[source] - start[target]) < 0.05
+        source, target = source[is_close], target[is_close]
+        result['pitch_class_transition_matrix'] = __window_sums(np.minimum(source, target), np.maximum(source, target), (pitch[source] % 12) * 12 + pitch[target] % 12,
+                                                                np.ones(len(source)), 144, windows).reshape(-1, 12, 12)
+
+    if 'avg_ioi' in names:
+        # the onsets are sorted, so the average inter onset interval of a window is the time between its first and last onset divided by the number of intervals
+        lo, hi = windows[:, 0], windows[:, 1]
+        has_interval = hi - lo > 1
+        span = np.where(has_interval, start[np.maximum(hi - 1, 0)] - start[np.minimum(lo, max(len(start) - 1, 0))], 0) if len(start) > 0 else np.zeros(len(windows))
+        result['avg_ioi'] = np.where(has_interval, span / np.maximum(hi - lo - 1, 1), 0)
+
+    return result
+
+
+def __per_bar_features(feature: dict, names: list, window_start: np.ndarray, window_bars: int):
+    """
+    Per bar features: computed once for all bars of the sequence, every window is a slice of window_bars rows.
+    """
+    metrics = core.metrics()
+    num_bar = int(window_start[-1]) + window_bars
+    per_bar = {
+        'pitch_count_per_bar': lambda: metrics.bar_used_pitch(feature, num_bar),
+        'pitch_class_histogram_per_bar': lambda: metrics.bar_pitch_class_histogram(feature, num_bar),
+        'note_count_per_bar': lambda: metrics.bar_used_note(feature, num_bar),
+    }
+    rows = window_start[:, np.newaxis] + np.arange(window_bars)
+    return {name: compute()[rows] for name, compute in per_bar.items() if name in names}
+
+
+def __rhythm_features(feature: dict, names: list, window_time: np.ndarray):
+    """
+    Features computed from the note events of the midi pattern: average pitch interval, note count, note length and ioi histograms and transition matrices.
+    """
+    pm = feature['pretty_midi']
+    events = core.extract_note_events(feature)
+    note_index = np.arange(len(events))
+    onset = np.array([pm.tick_to_time(int(tick)) for tick in events.onset])
+    windows = __note_ranges(onset, window_time)
+    result = {}
+
+    if 'avg_pitch_interval' in names:
+        interval = np.abs(np.diff(events.pitch)).astype(np.float64)
+        totals = __window_sums(note_index[:-1], note_index[1:], np.zeros(len(interval), dtype=np.int64), interval, 1, windows)[:, 0]
+        counts = np.maximum(windows[:, 1] - windows[:, 0] - 1, 0)
+        result['avg_pitch_interval'] = np.where(counts > 0, totals / np.maximum(counts, 1), 0)
+
+    if 'note_count' in names:
+        result['note_count'] = windows[:, 1] - windows[:, 0]
+
+    has_off = events.offset >= 0
+    note_idx, _ = events.length_class((events.offset - events.onset)[has_off], events.bar_length[has_off])
+    has_rest = (events.rest_before >= 0) & (note_index >= 1)
+    rest_idx, rest_distance = events.length_class(events.rest_before[has_rest], events.bar_length[has_rest])
+    is_close_rest = rest_distance < 3. * (events.bar_length[has_rest] / 96.)
+
+    if 'note_length_histogram' in names:
+        # a rest counts if the notes before and after it lie in the window
+        notes_with_off, rests = note_index[has_off], note_index[has_rest][is_close_rest]
+        histogram = __window_sums(np.concatenate((notes_with_off, rests - 1)), np.concatenate((notes_with_off, rests)),
+                                  np.concatenate((note_idx, rest_idx[is_close_rest] + 12)), np.ones(len(notes_with_off) + len(rests)), 24, windows)
+        result['note_length_histogram'] = histogram / np.sum(histogram, axis=1, keepdims=True)
+
+    if 'note_length_transition_matrix' in names:
+        # the steps of core.metrics.note_length_transition_matrix() (per note the note itself, then the rest before it) with the note they belong to
+        step_note = np.concatenate((note_index[has_off], note_index[has_rest]))
+        step_value = np.concatenate((note_idx, rest_idx))
+        step_is_note = np.concatenate((np.ones(len(note_idx), dtype=bool), np.zeros(len(rest_idx), dtype=bool)))
+        step_is_close_rest = np.concatenate((np.zeros(len(note_idx), dtype=bool), is_close_rest))
+        order = np.lexsort((~step_is_note, step_note))
+        step_note, step_value, step_is_note, step_is_close_rest = step_note[order], step_value[order], step_is_note[order], step_is_close_rest[order]
+
+        # the step that set the class carried into each step: the last note or rest that does not fit a length class
+        sets_class = step_is_note | ~step_is_close_rest
+        last_set = np.maximum.accumulate(np.where(sets_class, np.arange(len(step_note)), -1))
+        previous = last_set[np.maximum(np.arange(len(step_note)) - 1, 0)]
+        counted = (np.arange(len(step_note)) >= 1) & (previous >= 0) & (step_is_note | step_is_close_rest)
+        previous = previous[counted]
+        # a rest step also needs the note before the rest
+        step_first = np.where(step_is_note, step_note, step_note - 1)
+        first = np.minimum(step_first[previous], step_first[counted])
+        previous_class = step_value[previous]
+        column = np.where(step_is_note[counted], step_value[counted], previous_class + 12)
+        transitions = __window_sums(first, step_note[counted], previous_class * 24 + column, np.ones(len(first)), 576, windows)
+
+        # a window starting with a note whose rest before set the carried class misses that rest, the class is carried from the note itself instead
+        from_rest = ~step_is_note[previous] & (previous >= 1)
+        from_rest[from_rest] = step_is_note[previous[from_rest] - 1] & (step_note[previous[from_rest] - 1] == step_note[previous[from_rest]])
+        start_note = step_note[previous[from_rest]]
+        start_class = step_value[previous[from_rest] - 1]
+        start_column = np.where(step_is_note[counted][from_rest], step_value[counted][from_rest], start_class + 12)
+        transitions += __window_start_sums(start_note, step_note[counted][from_rest], start_class * 24 + start_column,
+                                           np.ones(len(start_note)), 576, windows)
+        result['note_length_transition_matrix'] = transitions.reshape(-1, 24, 24)
+
+    if 'ioi_histogram' in names or 'ioi_transition_matrix' in names:
+        # the inter onset interval of a note ends at the next note on event of any velocity: the note on of a later note, a note off (note on with
+        # velocity 0, as written by pretty_midi) of the note itself or, if the interval is 0, of the note before at the same tick
+        has_next = events.ioi >= 0
+        ioi_idx, _ = events.length_class(events.ioi[has_next], events.bar_length[has_next])
+        ioi_note = note_index[has_next]
+        ioi_end = events.onset[has_next] + events.ioi[has_next]
+        next_note = np.maximum(np.searchsorted(events.onset, ioi_end, side='left'), ioi_note + 1)
+        ends_at_onset = next_note < len(events)
+        ends_at_onset[ends_at_onset] = events.onset[next_note[ends_at_onset]] == ioi_end[ends_at_onset]
+        ends_at_onset &= events.offset[has_next] != ioi_end
+        from_previous = ~ends_at_onset & (events.ioi[has_next] == 0) & (ioi_note >= 1)
+        ioi_first = np.where(from_previous, ioi_note - 1, ioi_note)
+        ioi_last = np.where(ends_at_onset, next_note, ioi_note)
+
+        # a window starting with a note whose interval ends at the note off of the note before misses that note off,
+        # the interval ends at the note's own note off instead
+        has_own_off = from_previous & (events.offset[has_next] >= 0)
+        start_idx, _ = events.length_class((events.offset - events.onset)[has_next][has_own_off], events.bar_length[has_next][has_own_off])
+        start_note = ioi_note[has_own_off]
+
+        histogram = __window_sums(ioi_first, ioi_last, ioi_idx, np.ones(len(ioi_idx)), 12, windows)
+        histogram += __window_start_sums(start_note, start_note, start_idx, np.ones(len(start_note)), 12, windows)
+        result['ioi_histogram'] = histogram / np.sum(histogram, axis=1, keepdims=True)
+
+        transitions = __window_sums(ioi_first[:-1], np.maximum(ioi_last[:-1], ioi_last[1:]), ioi_idx[:-1] * 12 + ioi_idx[1:],
+                                    np.ones(max(len(ioi_idx) - 1, 0)), 144, windows)
+        has_own_off = has_own_off[:-1]
+        start_idx = start_idx[:np.sum(has_own_off)]
+        transitions += __window_start_sums(ioi_note[:-1][has_own_off], np.maximum(ioi_last[:-1], ioi_last[1:])[has_own_off],
+                                           start_idx * 12 + ioi_idx[1:][has_own_off], np.ones(len(start_idx)), 144, windows)
+        result['ioi_transition_matrix'] = transitions.reshape(-1, 12, 12)
+
+    return result
+
+
+###############################
+###        UTILITIES        ###
+###############################
+
+def __note_ranges(onset: np.ndarray, window_time: np.ndarray):
+    """
+    Returns:
+        np.ndarray: shape (num_windows, 2), [first note, last note + 1] of the notes (sorted by onset) starting in each window
+    """
+    return np.stack((np.searchsorted(onset, window_time[:, 0], side='left'), np.searchsorted(onset, window_time[:, 1], side='left')), axis=1)
+
+
+def __window_sums(first: np.ndarray, last: np.ndarray, index: np.ndarray, weight: np.ndarray, size: int, windows: np.ndarray):
+    """
+    Slides a window over the notes and sums up the weights of the items (single notes, rests or transitions) that lie completely in the window.
+    An item spans the notes first..last and adds its weight to entry index of the sum. While the window moves, only the items that enter
+    (their last note enters) and leave (their first note leaves) the window are added and subtracted, so every item is touched at most twice.
+
+    Args:
+        windows (np.ndarray): shape (num_windows, 2), note ranges [lo, hi) of the windows, lo and hi must not decrease
+
+    Returns:
+        np.ndarray: shape (num_windows, size), the sums of each window
+    """
+    first, last, index = np.asarray(first, dtype=np.int64), np.asarray(last, dtype=np.int64), np.asarray(index, dtype=np.int64)
+    weight = np.asarray(weight, dtype=np.float64)
+    by_last = np.argsort(last, kind='stable')
+    by_first = np.argsort(first, kind='stable')
+    sorted_last, sorted_first = last[by_last], first[by_first]
+
+    added = np.zeros(len(first), dtype=bool)
+    window_sum = np.zeros(size)
+    result = np.zeros((len(windows), size))
+    entered, left = 0, 0
+    for w, (lo, hi) in enumerate(windows):
+        # items whose last note entered the window
+        stop = np.searchsorted(sorted_last, hi, side='left')
+        entering = by_last[entered:stop]
+        entering = entering[first[entering] >= lo]
+        np.add.at(window_sum, index[entering], weight[entering])
+        added[entering] = True
+        entered = stop
+
+        # items whose first note left the window
+        stop = np.searchsorted(sorted_first, lo, side='left')
+        leaving = by_first[left:stop]
+        leaving = leaving[added[leaving]]
+        np.subtract.at(window_sum, index[leaving], weight[leaving])
+        added[leaving] = False
+        left = stop
+
+        result[w] = window_sum
+    return result
+
+
+def __window_start_sums(first: np.ndarray, last: np.ndarray, index: np.ndarray, weight: np.ndarray, size: int, windows: np.ndarray):
+    """
+    Sums up the weights of the items that only count if the window starts exactly at their first note (and their last note lies in the window).
+
+    Returns:
+        np.ndarray: shape (num_windows, size), the sums of each window
+    """
+    first, last, index = np.asarray(first, dtype=np.int64), np.asarray(last, dtype=np.int64), np.asarray(index, dtype=np.int64)
+    order = np.argsort(first, kind='stable')
+    first, last, index, weight = first[order], last[order], index[order], np.asarray(weight, dtype=np.float64)[order]
+
+    begin = np.searchsorted(first, windows[:, 0], side='left')
+    end = np.searchsorted(first, windows[:, 0], side='right')
+    count = end - begin
+    item = np.arange(np.sum(count)) - np.repeat(np.cumsum(count) - count, count) + np.repeat(begin, count)
+    window = np.repeat(np.arange(len(windows)), count)
+    in_window = last[item] < windows[window, 1]
+
+    result = np.zeros((len(windows), size))
+    np.add.at(result, (window[in_window], index[item[in_window]]), weight[item[in_window]])
+    return result